@@ -0,0 +1,298 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+import psycopg2
+from settings import get_config
+from sql_objects import sql_tasks, table_order, staging_tables, table_columns, get_query
+from converter import get_json_keys, list_json_files, iter_rows, local_sources
+from generator import generate_dataset
+from instrumentation import compare_reports
+
+# Redshift table attributes PostgreSQL does not know about
+redshift_attributes = re.compile(r'\s*\b(?:DISTSTYLE\s+\w+|DISTKEY\s*\([^)]*\)|(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\))',
+                                 re.IGNORECASE)
+
+def split_select_list(select_list):
+    """Splits a SELECT list on its top-level commas"""
+    items, depth, current = [], 0, ''
+    for char in select_list:
+        if char == ',' and depth == 0:
+            items.append(current)
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    return items + [current]
+
+def find_select_list(query):
+    """Returns the start and end positions of the SELECT list of the first SELECT of a statement (None if there is none)"""
+    match = re.search(r'\bSELECT\s+(?:DISTINCT\s+)?', query, re.IGNORECASE)
+    if match is None:
+        return None
+    depth = 0
+    for position in range(match.end(), len(query)):
+        depth += {'(': 1, ')': -1}.get(query[position], 0)
+        if depth == 0 and re.match(r'\bFROM\b', query[position:], re.IGNORECASE) and not query[position - 1].isalnum():
+            return match.end(), position
+    return None
+
+def inline_column_aliases(query):
+    """Replaces references to a column alias defined earlier in the same SELECT list by its expression
+
+    Redshift resolves such lateral aliases (e.g. EXTRACT(HOUR FROM ts_timestamp)), PostgreSQL does not.
+
+    Args:
+        query (string): SQL statement
+
+    Returns:
+        string: SQL statement without lateral alias references
+    """
+    bounds = find_select_list(query)
+    if bounds is None:
+        return query
+
+    aliases, items = {}, []
+    for item in split_select_list(query[bounds[0]:bounds[1]]):
+        for alias, expression in aliases.items():
+            item = re.sub(r'\b{}\b'.format(alias), '({})'.format(expression), item)
+        alias_match = re.match(r'\s*(.*?)\s+as\s+(\w+)\s*$', item, re.IGNORECASE | re.DOTALL)
+        if alias_match:
+            aliases[alias_match.group(2)] = alias_match.group(1)
+        items.append(item)
+    return query[:bounds[0]] + ','.join(items) + query[bounds[1]:]
+
+def to_postgres(query):
+    """Translates a Redshift statement to PostgreSQL
+
+    Drops ENCODE, DISTSTYLE, DISTKEY & SORTKEY, turns IDENTITY columns into identity columns
+    and inlines lateral column aliases. TIMESTAMP 'epoch' + INTERVAL arithmetic runs as is.
+
+    Args:
+        query (string): Redshift SQL statement
+
+    Returns:
+        string: PostgreSQL statement
+    """
+    query = re.sub(r'\s+ENCODE\s+\w+', '', query, flags=re.IGNORECASE)
+    query = redshift_attributes.sub('', query)
+    query = re.sub(r'\bIDENTITY\s*\(\s*(-?\d+)\s*,\s*(\d+)\s*\)',
+                   r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)', query, flags=re.IGNORECASE)
+    return inline_column_aliases(query)
+
+def open_local_connection(config):
+    """Opens a connection to the local PostgreSQL the benchmark runs against
+
+    Args:
+        config (ConfigParser object): Configuration File defining the [BENCHMARK] section
+
+    Returns:
+        connection object: Connection to PostgreSQL
+    """
+    return psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+        config.get('BENCHMARK', 'HOST'), config.get('BENCHMARK', 'DB_NAME'), config.get('BENCHMARK', 'DB_USER'),
+        config.get('BENCHMARK', 'DB_PASSWORD'), config.getint('BENCHMARK', 'DB_PORT')))
+
+def copy_local(cur, table, data_dir, chunk_rows=10000):
+    """Local equivalent of the staging COPY: streams the JSON files of a staging table through COPY FROM STDIN
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        table (string): Staging table name
+        data_dir (string): Dataset directory holding song_data/, log_data/ and log_json_path.json
+        chunk_rows (int): Number of rows sent per COPY
+
+    Returns:
+        int: Number of rows loaded
+    """
+    columns = table_columns[table]
+    keys = get_json_keys(table, os.path.join(data_dir, 'log_json_path.json'))
+    files = list_json_files(os.path.join(data_dir, local_sources[table].lower()))
+    copy = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table, ', '.join(column for column, _ in columns))
+
+    rows = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in iter_rows(files, keys, columns):
+        writer.writerow(row)
+        rows += 1
+        if rows % chunk_rows == 0:
+            buffer.seek(0)
+            cur.copy_expert(copy, buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+    if buffer.tell():
+        buffer.seek(0)
+        cur.copy_expert(copy, buffer)
+    return rows
+
+def timed(entries, phase, name, function, *args):
+    """Runs a step and records its duration and rows
+
+    Args:
+        entries (list): Statement entries of the run
+        phase (string): Pipeline phase (e.g. create, load_staging, transform, validation)
+        name (string): Statement name (usually the target table)
+        function (function): Step, returns the number of rows it affected
+        *args: Arguments of the step
+    """
+    start = time.time()
+    rows = function(*args)
+    entries.append({'phase': phase, 'name': name, 'duration': time.time() - start, 'rows': rows})
+
+def execute(cur, query, fetch=False):
+    """Executes a translated statement (or list of statements), returning the rows the last one affected (or fetched)"""
+    rows = None
+    for statement in query if isinstance(query, list) else [query]:
+        cur.execute(to_postgres(statement))
+        if cur.rowcount >= 0:
+            rows = cur.rowcount
+    if fetch:
+        return len(cur.fetchall())
+    return rows
+
+def run_pipeline(cur, conn, data_dir, chunk_rows):
+    """Runs the DDL, the staging load, the inserts and the validation questions once
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to PostgreSQL
+        data_dir (string): Dataset directory
+        chunk_rows (int): Number of rows sent per COPY
+
+    Returns:
+        list: Statement entries with phase, name, duration & rows
+    """
+    entries = []
+    for table in reversed(table_order):
+        execute(cur, sql_tasks[table]['drop'])
+    conn.commit()
+
+    for table in table_order:
+        timed(entries, 'create', table, execute, cur, sql_tasks[table]['create'])
+    conn.commit()
+
+    for table in staging_tables:
+        timed(entries, 'load_staging', table, copy_local, cur, table, data_dir, chunk_rows)
+        conn.commit()
+
+    for table in table_order:
+        if table not in staging_tables:
+            timed(entries, 'transform', table, execute, cur, sql_tasks[table]['load'])
+            conn.commit()
+
+    cur.execute('ANALYZE;')
+    conn.commit()
+    for question_number in (1, 2, 3):
+        timed(entries, 'validation', f'question_{question_number}', execute, cur, get_query(question_number, use_views=False), True)
+    return entries
+
+def summarize(runs, scale_factor):
+    """Aggregates the entries of repeated runs into one statement per step, keeping its median duration
+
+    Args:
+        runs (list): Statement entries of each run
+        scale_factor (float): Scale factor of the dataset
+
+    Returns:
+        list: Statements in the run report format, with the duration of every run
+    """
+    statements = []
+    for i, entry in enumerate(runs[0]):
+        durations = [round(run[i]['duration'], 4) for run in runs]
+        statements.append({
+            'phase': entry['phase'],
+            'name': '{}@sf{}'.format(entry['name'], scale_factor),
+            'scale_factor': scale_factor,
+            'duration': round(statistics.median(durations), 4),
+            'min_duration': min(durations),
+            'max_duration': max(durations),
+            'durations': durations,
+            'rows': entry['rows'],
+            'copy_rows': entry['rows'] if entry['phase'] == 'load_staging' else None
+        })
+    return statements
+
+def run_benchmark(scale_factors=None, runs=None):
+    """Benchmarks the SQL pipeline on a local PostgreSQL over generated datasets of several sizes
+
+    Args:
+        scale_factors (list): Dataset sizes relative to the udacity-dend datasets (defaults to SCALE_FACTORS on the cfg file)
+        runs (int): Number of runs per dataset (defaults to RUNS on the cfg file)
+
+    Returns:
+        dictionary: Benchmark results in the run report format
+    """
+    config = get_config()
+    if scale_factors is None:
+        scale_factors = [float(value) for value in config.get('BENCHMARK', 'SCALE_FACTORS', fallback='0.1,1').split(',')]
+    if runs is None:
+        runs = config.getint('BENCHMARK', 'RUNS', fallback=3)
+    data_root = config.get('BENCHMARK', 'DATA_DIR', fallback='benchmark_data')
+    chunk_rows = config.getint('LOCAL', 'CHUNK_ROWS', fallback=10000)
+    skew = config.getfloat('GENERATOR', 'SKEW', fallback=1.0)
+    seed = config.getint('GENERATOR', 'SEED', fallback=42)
+
+    results = {'mode': 'benchmark', 'started_at': datetime.utcnow().isoformat(), 'runs': runs,
+               'scale_factors': scale_factors, 'threshold': config.getfloat('BENCHMARK', 'THRESHOLD', fallback=1.2),
+               'statements': []}
+    start = time.time()
+
+    conn = open_local_connection(config)
+    cur = conn.cursor()
+    try:
+        for scale_factor in scale_factors:
+            data_dir = os.path.join(data_root, 'sf{}'.format(scale_factor))
+            if not os.path.exists(os.path.join(data_dir, 'log_json_path.json')):
+                generate_dataset(data_dir, scale_factor, skew, seed)
+
+            scale_runs = []
+            for run in range(runs):
+                print(f'Scale factor {scale_factor}, run {run + 1} of {runs}...')
+                scale_runs.append(run_pipeline(cur, conn, data_dir, chunk_rows))
+            results['statements'].extend(summarize(scale_runs, scale_factor))
+    finally:
+        conn.close()
+
+    results['duration'] = round(time.time() - start, 3)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the SQL pipeline against a local PostgreSQL')
+    parser.add_argument('--scale-factors', help='Comma separated dataset sizes (defaults to SCALE_FACTORS on the cfg file)')
+    parser.add_argument('--runs', type=int, help='Number of runs per dataset (defaults to RUNS on the cfg file)')
+    parser.add_argument('--baseline', help='Results file to compare with (defaults to BASELINE on the cfg file)')
+    args = parser.parse_args()
+
+    config = get_config()
+    scale_factors = [float(value) for value in args.scale_factors.split(',')] if args.scale_factors else None
+    try:
+        results = run_benchmark(scale_factors, args.runs)
+    except (psycopg2.Error, OSError, ValueError) as e:
+        print(f'ERROR: {e}')
+        sys.exit(2)
+
+    baseline_path = args.baseline or config.get('BENCHMARK', 'BASELINE', fallback='')
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        results['comparison'] = compare_reports(baseline, results, results['threshold'])
+        results['regressions'] = [item for item in results['comparison'] if item['regression']]
+
+    output = config.get('BENCHMARK', 'OUTPUT', fallback='benchmark_results.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for item in results['statements']:
+        print('{:<14} {:<30} {:>10} {:>12}'.format(item['phase'], item['name'], item['duration'], str(item['rows'])))
+    for item in results.get('regressions', []):
+        print('REGRESSION: {} {} {}s -> {}s (x{})'.format(item['phase'], item['name'], item['baseline_duration'],
+                                                          item['current_duration'], item['ratio']))
+    print(f'Results written to {output}')
+    sys.exit(1 if results.get('regressions') else 0)
@@ -0,0 +1,334 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import re
+from settings import get_config, get_client
+from manifest import split_s3_url
+from sql_objects import table_columns, staging_suffixes, get_staging_format, get_staging_source
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+# Local config key holding the raw JSON directory of each staging table
+local_sources = {'staging_events': 'LOG_DATA', 'staging_songs': 'SONG_DATA'}
+
+def read_jsonpaths(path):
+    """Reads the JSON keys of a JSONPaths file, in column order
+
+    Args:
+        path (string): Local JSONPaths file (e.g. log_json_path.json)
+
+    Returns:
+        list: JSON key of each column
+    """
+    with open(path) as f:
+        jsonpaths = json.load(f)['jsonpaths']
+    keys = []
+    for jsonpath in jsonpaths:
+        match = re.match(r"""\$(?:\[['"](.+)['"]\]|\.(.+))$""", jsonpath.strip())
+        if match is None:
+            raise ValueError(f'Unsupported JSONPath expression {jsonpath}')
+        keys.append(match.group(1) or match.group(2))
+    return keys
+
+def get_json_keys(table, jsonpath):
+    """Returns the JSON key of each column of a staging table
+
+    Log keys follow the JSONPaths file, song keys are matched by column name like FORMAT AS JSON 'auto'.
+
+    Args:
+        table (string): Staging table name
+        jsonpath (string): Local JSONPaths file of the log data
+
+    Returns:
+        list: JSON key of each column
+    """
+    if table == 'staging_events':
+        keys = read_jsonpaths(jsonpath)
+    else:
+        keys = [column for column, _ in table_columns[table]]
+    if len(keys) != len(table_columns[table]):
+        raise ValueError(f'{table} has {len(table_columns[table])} columns but {len(keys)} JSON keys are mapped')
+    return keys
+
+def list_json_files(directory):
+    """Lists every JSON file under a local directory, in a stable order
+
+    Args:
+        directory (string): Local directory (e.g. data/log_data)
+
+    Returns:
+        list: Paths of the JSON files
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        files.extend(os.path.join(root, name) for name in names if name.endswith('.json'))
+    return sorted(files)
+
+def iter_json_records(path):
+    """Yields the records of a JSON file holding one object per line or a single (possibly indented) object
+
+    Args:
+        path (string): Local JSON file
+
+    Yields:
+        dictionary: JSON record
+    """
+    with open(path) as f:
+        first_line = True
+        try:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    first_line = False
+                    yield record
+            return
+        except json.JSONDecodeError:
+            if not first_line:
+                raise
+            f.seek(0)
+            records = json.load(f)
+    yield from records if isinstance(records, list) else [records]
+
+def coerce(value, column_type):
+    """Converts a JSON value to the type of its staging column, loading empty strings as NULL
+
+    Args:
+        value (object): JSON value
+        column_type (string): Column definition (e.g. 'BIGINT')
+
+    Returns:
+        object: Converted value (None for NULL)
+    """
+    if value is None or value == '':
+        return None
+    if column_type in ('INT', 'BIGINT'):
+        return int(float(value))
+    if column_type == 'FLOAT':
+        return float(value)
+    return str(value)
+
+def iter_rows(files, keys, columns):
+    """Yields the staging rows of a set of JSON files
+
+    Args:
+        files (list): Local JSON files
+        keys (list): JSON key of each column
+        columns (list): Staging table (column, type) tuples
+
+    Yields:
+        tuple: Row in the staging table column order
+    """
+    for path in files:
+        for record in iter_json_records(path):
+            yield tuple(coerce(record.get(key), column_type) for key, (_, column_type) in zip(keys, columns))
+
+class CsvPartitionWriter:
+    """Writes rows to gzip'd CSV files of at most rows_per_file rows, with a header line
+
+    Args:
+        directory (string): Output directory
+        prefix (string): File name prefix
+        columns (list): Staging table (column, type) tuples
+        rows_per_file (int): Maximum number of rows per file
+    """
+
+    suffix = staging_suffixes['csv']
+
+    def __init__(self, directory, prefix, columns, rows_per_file):
+        self.directory = directory
+        self.prefix = prefix
+        self.columns = columns
+        self.rows_per_file = max(1, rows_per_file)
+        self.files = []
+        self.file = None
+        self.writer = None
+        self.rows = 0
+
+    def open_partition(self):
+        """Starts a new file"""
+        self.close_partition()
+        path = os.path.join(self.directory, '{}-{:05d}{}'.format(self.prefix, len(self.files), self.suffix))
+        self.file = gzip.open(path, 'wt', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column for column, _ in self.columns])
+        self.files.append(path)
+        self.rows = 0
+
+    def close_partition(self):
+        """Finishes the current file"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, rows):
+        """Writes a chunk of rows, starting new files as they fill up"""
+        for row in rows:
+            if self.file is None or self.rows >= self.rows_per_file:
+                self.open_partition()
+            self.writer.writerow(row)
+            self.rows += 1
+
+    def close(self):
+        """Finishes the output"""
+        self.close_partition()
+
+# Parquet type of each staging column type
+parquet_types = {'VARCHAR': 'string', 'CHAR': 'string', 'INT': 'int32', 'BIGINT': 'int64', 'FLOAT': 'float64'}
+
+class ParquetPartitionWriter(CsvPartitionWriter):
+    """Writes rows to Parquet files of at most rows_per_file rows, one row group per chunk
+
+    Args:
+        directory (string): Output directory
+        prefix (string): File name prefix
+        columns (list): Staging table (column, type) tuples
+        rows_per_file (int): Maximum number of rows per file
+    """
+
+    suffix = staging_suffixes['parquet']
+
+    def __init__(self, directory, prefix, columns, rows_per_file):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required to write Parquet files (pip install pyarrow), or use the csv format')
+        super().__init__(directory, prefix, columns, rows_per_file)
+        self.schema = pyarrow.schema([(column, parquet_types[column_type]) for column, column_type in columns])
+
+    def open_partition(self):
+        """Starts a new file"""
+        self.close_partition()
+        path = os.path.join(self.directory, '{}-{:05d}{}'.format(self.prefix, len(self.files), self.suffix))
+        self.file = pq.ParquetWriter(path, self.schema, compression='snappy')
+        self.files.append(path)
+        self.rows = 0
+
+    def write(self, rows):
+        """Writes a chunk of rows, starting new files as they fill up"""
+        while rows:
+            if self.file is None or self.rows >= self.rows_per_file:
+                self.open_partition()
+            part, rows = rows[:self.rows_per_file - self.rows], rows[self.rows_per_file - self.rows:]
+            self.file.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(values, type=field.type) for values, field in zip(zip(*part), self.schema)],
+                schema=self.schema))
+            self.rows += len(part)
+
+partition_writers = {'csv': CsvPartitionWriter, 'parquet': ParquetPartitionWriter}
+
+def convert_table(table, files, keys, output_dir, staging_format, chunk_rows, rows_per_file):
+    """Converts the JSON files of a staging table, holding at most chunk_rows rows in memory
+
+    Args:
+        table (string): Staging table name
+        files (list): Local JSON files
+        keys (list): JSON key of each column
+        output_dir (string): Output directory, the files are written to output_dir/<table>/
+        staging_format (string): csv or parquet
+        chunk_rows (int): Number of rows converted at a time
+        rows_per_file (int): Maximum number of rows per output file
+
+    Returns:
+        list: Paths of the files written
+    """
+    directory = os.path.join(output_dir, table)
+    os.makedirs(directory, exist_ok=True)
+    # Files keep the same names across conversions and the previous output is replaced, never added to
+    for name in os.listdir(directory):
+        if name.startswith('part-'):
+            os.remove(os.path.join(directory, name))
+    writer = partition_writers[staging_format](directory, 'part', table_columns[table], rows_per_file)
+
+    chunk = []
+    try:
+        for row in iter_rows(files, keys, table_columns[table]):
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                writer.write(chunk)
+                chunk = []
+        if chunk:
+            writer.write(chunk)
+    finally:
+        writer.close()
+    return writer.files
+
+def upload_files(table, files, staging_format, client=None):
+    """Uploads converted files to the STAGED_DATA prefix of their staging table, replacing the previous conversion
+
+    Files are uploaded over the keys of the same name, then every other key under the prefix is deleted,
+    so a COPY of the prefix only loads the current conversion.
+
+    Args:
+        table (string): Staging table name
+        files (list): Local files to upload
+        staging_format (string): csv or parquet
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+
+    Returns:
+        list: S3 urls of the uploaded files
+    """
+    client = client or get_client('s3')
+    bucket, prefix = split_s3_url(get_staging_source(table, staging_format))
+    urls = []
+    for path in files:
+        key = prefix + os.path.basename(path)
+        client.upload_file(path, bucket, key)
+        urls.append('s3://{}/{}'.format(bucket, key))
+
+    uploaded = set(prefix + os.path.basename(path) for path in files)
+    stale = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        stale.extend(item['Key'] for item in page.get('Contents', []) if item['Key'] not in uploaded)
+    for i in range(0, len(stale), 1000):
+        client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in stale[i:i + 1000]]})
+    if stale:
+        print(f'{table}: {len(stale)} files of a previous conversion deleted')
+    return urls
+
+def convert_local_data(staging_format=None, upload=False):
+    """Converts the local log & song JSON into the staging table schemas, optionally uploading the files to S3
+
+    Args:
+        staging_format (string): csv or parquet (defaults to STAGING_FORMAT on the cfg file, csv when it is json)
+        upload (boolean): Whether to upload the files to STAGED_DATA on the cfg file
+
+    Returns:
+        dictionary: Staging table name mapped to the files written
+    """
+    config = get_config()
+    staging_format = staging_format or get_staging_format()
+    if staging_format == 'json':
+        staging_format = 'csv'
+    if staging_format not in partition_writers:
+        raise ValueError(f'Unknown format {staging_format}, use csv or parquet')
+
+    output_dir = config.get('LOCAL', 'STAGED_DIR', fallback='staged')
+    chunk_rows = config.getint('LOCAL', 'CHUNK_ROWS', fallback=10000)
+    rows_per_file = config.getint('LOCAL', 'ROWS_PER_FILE', fallback=500000)
+
+    written = {}
+    for table in local_sources:
+        keys = get_json_keys(table, config.get('LOCAL', 'LOG_JSONPATH'))
+        files = list_json_files(config.get('LOCAL', local_sources[table]))
+        print(f'Converting {len(files)} JSON files into {table}...')
+        written[table] = convert_table(table, files, keys, output_dir, staging_format, chunk_rows, rows_per_file)
+        print(f'{table}: {len(written[table])} {staging_format} files written to {os.path.join(output_dir, table)}')
+        if upload:
+            urls = upload_files(table, written[table], staging_format)
+            print(f'{table}: {len(urls)} files uploaded to {get_staging_source(table, staging_format)}')
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the local log & song JSON into files COPY loads faster')
+    parser.add_argument('--format', choices=sorted(partition_writers), help='Output format (defaults to STAGING_FORMAT on the cfg file)')
+    parser.add_argument('--upload', action='store_true', help='Upload the files to STAGED_DATA on the cfg file')
+    args = parser.parse_args()
+
+    try:
+        convert_local_data(args.format, args.upload)
+    except (OSError, ValueError, ImportError) as e:
+        print(f'ERROR: {e}')
@@ -1,51 +1,11 @@
-import boto3
 import time
 import json
-import configparser
-from botocore.exceptions import ClientError
-
-# Define config_file
-config_file = 'dwh.cfg'
-
-# Reading cfg file
-config = configparser.ConfigParser()
-config.read(config_file)
-
-# Setting up Access Key and Secret Key
-KEY = config.get('AWS','KEY')
-SECRET = config.get('AWS','SECRET')
+from concurrent.futures import ThreadPoolExecutor
+from settings import config_file, get_config, get_client, update_config_file, client_error
 
 # Define policy to be attached to IAM role
 s3_arn_policy = 'arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess'
 
-# Define AWS Services
-redshift_client = boto3.client('redshift', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-iam_client = boto3.client('iam', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-ec2_client = boto3.client('ec2', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-
-def update_config_file(config_file, section, key, value):
-    """Writes to an existing config file
-
-    Args:
-        config_file (ConfigParser object): Configuration file the user wants to update
-        section (string): The section on the config file the user wants to write
-        key (string): The key the user wants to write
-        value (string): The value the user wants to write
-    """
-    try:
-        # Reading cfg file
-        config = configparser.ConfigParser()
-        config.read(config_file)
-
-        #Setting  Section, Key and Value to be write on the cfg file
-        config.set(section, key, value)
-
-        # Writting to cfg file
-        with open(config_file, 'w') as f:
-            config.write(f)
-    except ClientError as e:
-        print(f'ERROR: {e}')
-
 def create_iam_role(config, arn_policy):
     """Creates IAM Role on AWS
 
@@ -57,7 +17,7 @@ def create_iam_role(config, arn_policy):
       dictionary: IAM Role Information
     """
     try:
-        response = iam_client.get_role(RoleName=config.get('SECURITY', 'ROLE_NAME'))
+        response = get_client('iam').get_role(RoleName=config.get('SECURITY', 'ROLE_NAME'))
         print('IAM Role already exists: ' + response['Role']['Arn'])
         return response
     except:
@@ -65,7 +25,7 @@ def create_iam_role(config, arn_policy):
 
     if response is None:
         try:
-            role = iam_client.create_role(
+            role = get_client('iam').create_role(
             RoleName = config.get('SECURITY', 'ROLE_NAME'),
             Description = 'Allows Redshift to call AWS services on your behalf',
             AssumeRolePolicyDocument = json.dumps({
@@ -77,13 +37,13 @@ def create_iam_role(config, arn_policy):
                     }]
                 })
             )
-            iam_client.attach_role_policy(
+            get_client('iam').attach_role_policy(
                 RoleName = config.get('SECURITY', 'ROLE_NAME'),
                 PolicyArn = arn_policy
             )
             print('IAM Role Created: %s.' % (config.get('SECURITY', 'ROLE_NAME')))
             return role
-        except ClientError as e:
+        except client_error() as e:
           print(e)
 
 def create_cluster_security_group():
@@ -92,9 +52,10 @@ def create_cluster_security_group():
   Returns:
       string: Security Group ID
   """
+  config = get_config()
   try:
-    response = ec2_client.describe_security_groups(Filters= [{"Name": "group-name", "Values": [config.get('SECURITY', 'SG_Name')]}])
-  except ClientError as e:
+    response = get_client('ec2').describe_security_groups(Filters= [{"Name": "group-name", "Values": [config.get('SECURITY', 'SG_Name')]}])
+  except client_error() as e:
      print(e)
 
   if len(response['SecurityGroups']) > 0:
@@ -106,15 +67,15 @@ def create_cluster_security_group():
   if response is None:
     vpc_id = config.get('SECURITY', 'VPC_ID')
     if vpc_id == "":
-      response = ec2_client.describe_vpcs()
+      response = get_client('ec2').describe_vpcs()
       vpc_id = response.get('Vpcs', [{}])[0].get('VpcId', '')
 
     try:
-        response = ec2_client.create_security_group(GroupName=config.get('SECURITY', 'SG_Name'),Description='Redshift security group',VpcId=vpc_id)
+        response = get_client('ec2').create_security_group(GroupName=config.get('SECURITY', 'SG_Name'),Description='Redshift security group',VpcId=vpc_id)
         security_group_id = response['GroupId']
         print('Security Group Created %s in vpc %s.' % (security_group_id, vpc_id))
 
-        ec2_client.authorize_security_group_ingress(
+        get_client('ec2').authorize_security_group_ingress(
             GroupId=security_group_id,
             IpPermissions=[
                 {'IpProtocol': 'tcp',
@@ -127,30 +88,198 @@ def create_cluster_security_group():
                  'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}
             ])
         return security_group_id
-    except ClientError as e:
+    except client_error() as e:
         print(e)
 
-def create_redshift_cluster(config, iam_role_arn, cluster_sg_id):
-   """Creates an Amazon Redshift cluster on AWS
+def get_latest_snapshot(config):
+    """Returns the latest available manual snapshot of the cluster
+
+    Args:
+      config (ConfigParser object): Configuration File to define Resource configuration
+
+    Returns:
+      string: Snapshot identifier (None if the cluster has no snapshot)
+    """
+    try:
+        response = get_client('redshift').describe_cluster_snapshots(
+            ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'),
+            SnapshotType='manual'
+        )
+    except client_error() as e:
+        print(f'ERROR: {e}')
+        return None
+
+    snapshots = [snapshot for snapshot in response['Snapshots'] if snapshot['Status'] == 'available']
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])['SnapshotIdentifier']
+
+def restore_redshift_cluster(config, snapshot_id, iam_role_arn, cluster_sg_id, parameter_group=None):
+    """Restores the Amazon Redshift cluster from a snapshot instead of creating an empty one
+
+    Args:
+      config (ConfigParser object): Configuration File to define Resource configuration
+      snapshot_id (string): Snapshot to restore from
+      iam_role_arn (string): AWS IAM role to attached on Cluster
+      cluster_sg_id (string): AWS VPC Security Group ID
+      parameter_group (string): Cluster parameter group holding the WLM configuration (None keeps the default one)
+
+    Returns:
+      dictionary: AWS Redshift Cluster Information
+    """
+    parameter_group_options = {'ClusterParameterGroupName': parameter_group} if parameter_group else {}
+    try:
+        response = get_client('redshift').restore_from_cluster_snapshot(
+            ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'),
+            SnapshotIdentifier=snapshot_id,
+            NodeType=config.get('CLUSTER', 'NODETYPE'),
+            NumberOfNodes=config.getint('CLUSTER', 'NUMBEROFNODES'),
+            PubliclyAccessible=True,
+            Port=config.getint('CLUSTER', 'DB_PORT'),
+            IamRoles=[iam_role_arn],
+            VpcSecurityGroupIds=[cluster_sg_id],
+            **parameter_group_options
+        )
+        print(f'Restoring cluster from snapshot {snapshot_id}.')
+        return response['Cluster']
+    except client_error() as e:
+        print(f'ERROR: {e}')
+        return None
+
+def resume_redshift_cluster(config):
+    """Resumes a paused Amazon Redshift cluster
+
+    Args:
+      config (ConfigParser object): Configuration File to define Resource configuration
+
+    Returns:
+      dictionary: AWS Redshift Cluster Information
+    """
+    try:
+        response = get_client('redshift').resume_cluster(ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'))
+        print('Resuming paused cluster: ' + response['Cluster']['ClusterIdentifier'])
+        return response['Cluster']
+    except client_error() as e:
+        print(f'ERROR: {e}')
+        return None
+
+def build_wlm_configuration(config):
+    """Builds the manual WLM configuration separating the ETL and interactive queries
+
+    The ETL and interactive queues are picked by query group, the default queue takes the remaining memory.
+
+    Args:
+      config (ConfigParser object): Configuration File defining the [WLM] section
+
+    Returns:
+      string: JSON value of the wlm_json_configuration parameter
+    """
+    queues = []
+    for workload in ['ETL', 'INTERACTIVE']:
+        queues.append({
+            'query_group': [config.get('WLM', f'{workload}_QUERY_GROUP')],
+            'query_group_wild_card': 0,
+            'memory_percent_to_use': config.getint('WLM', f'{workload}_MEMORY_PERCENT'),
+            'query_concurrency': config.getint('WLM', f'{workload}_CONCURRENCY')
+        })
+
+    remaining = 100 - sum(queue['memory_percent_to_use'] for queue in queues)
+    if remaining <= 0:
+        raise ValueError('ETL_MEMORY_PERCENT and INTERACTIVE_MEMORY_PERCENT must leave memory to the default queue')
+    queues.append({'memory_percent_to_use': remaining, 'query_concurrency': config.getint('WLM', 'DEFAULT_CONCURRENCY', fallback=5)})
+    queues.append({'short_query_queue': True})
+    return json.dumps(queues)
+
+def create_parameter_group(config):
+    """Creates the cluster parameter group holding the WLM configuration, updating it if it already exists
+
+    Args:
+      config (ConfigParser object): Configuration File to define Resource configuration
+
+    Returns:
+      string: Parameter group name (None if WLM is disabled or the group could not be set up)
+    """
+    if not config.getboolean('WLM', 'ENABLED', fallback=False):
+        return None
+
+    name = config.get('WLM', 'PARAMETER_GROUP')
+    try:
+        get_client('redshift').describe_cluster_parameter_groups(ParameterGroupName=name)
+        print('Parameter Group already exists: ' + name)
+    except client_error():
+        try:
+            get_client('redshift').create_cluster_parameter_group(
+                ParameterGroupName=name,
+                ParameterGroupFamily='redshift-1.0',
+                Description='Separate WLM queues for ETL and interactive queries'
+            )
+            print('Parameter Group Created: ' + name)
+        except client_error() as e:
+            print(f'ERROR: {e}')
+            return None
+
+    try:
+        get_client('redshift').modify_cluster_parameter_group(
+            ParameterGroupName=name,
+            Parameters=[{'ParameterName': 'wlm_json_configuration', 'ParameterValue': build_wlm_configuration(config)}]
+        )
+    except (client_error(), ValueError) as e:
+        print(f'ERROR: {e}')
+        return None
+    return name
+
+def attach_parameter_group(cluster, parameter_group):
+    """Attaches the parameter group to an existing cluster, if it is not attached yet
+
+    Args:
+      cluster (dictionary): AWS Redshift Cluster Information
+      parameter_group (string): Parameter group name (None does nothing)
+    """
+    if parameter_group is None:
+        return
+    if parameter_group in [group['ParameterGroupName'] for group in cluster.get('ClusterParameterGroups', [])]:
+        return
+    try:
+        get_client('redshift').modify_cluster(ClusterIdentifier=cluster['ClusterIdentifier'], ClusterParameterGroupName=parameter_group)
+        print(f'Parameter Group {parameter_group} attached, reboot the cluster to apply the WLM configuration.')
+    except client_error() as e:
+        print(f'ERROR: {e}')
+
+def create_redshift_cluster(config, iam_role_arn, cluster_sg_id, parameter_group=None):
+   """Creates an Amazon Redshift cluster on AWS, resuming it if paused or restoring the latest snapshot when RESTORE_FROM_SNAPSHOT is set
 
    Args:
       config (ConfigParser object): Configuration File to define Resource configuration
       iam_role_arn (string): AWS IAM role to attached on Cluster
       cluster_sg_id (string): AWS VPC Security Group ID
+      parameter_group (string): Cluster parameter group holding the WLM configuration (None keeps the default one)
 
    Returns:
       dictionary: AWS Redshift Cluster Information
    """
    try:
-     response = redshift_client.describe_clusters(ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'))
-     print('Redshift Cluster already exists: ' + response['Clusters'][0]['ClusterIdentifier'])
-     return None
+     response = get_client('redshift').describe_clusters(ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'))
    except:
      response = None
 
+   if response is not None:
+     if response['Clusters'][0]['ClusterStatus'] == 'paused':
+       return resume_redshift_cluster(config)
+     attach_parameter_group(response['Clusters'][0], parameter_group)
+     print('Redshift Cluster already exists: ' + response['Clusters'][0]['ClusterIdentifier'])
+     return None
+
+   if response is None and config.getboolean('SNAPSHOT', 'RESTORE_FROM_SNAPSHOT', fallback=False):
+     snapshot_id = get_latest_snapshot(config)
+     if snapshot_id is not None:
+       return restore_redshift_cluster(config, snapshot_id, iam_role_arn, cluster_sg_id, parameter_group)
+
+   # Without a parameter group the cluster gets the default one
+   parameter_group_options = {'ClusterParameterGroupName': parameter_group} if parameter_group else {}
+
    if response is None:
      try:
-       response = redshift_client.create_cluster(
+       response = get_client('redshift').create_cluster(
        ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER')
        ,ClusterType=config.get('CLUSTER', 'CLUSTERTYPE')
        ,NumberOfNodes=config.getint('CLUSTER', 'NUMBEROFNODES')
@@ -162,47 +291,129 @@ def create_redshift_cluster(config, iam_role_arn, cluster_sg_id):
        ,Port=config.getint('CLUSTER', 'DB_PORT')
        ,IamRoles=[iam_role_arn]
        ,VpcSecurityGroupIds=[cluster_sg_id]
+       ,**parameter_group_options
        )
        return response['Cluster']
-     except ClientError as e:
+     except client_error() as e:
        print(f'ERROR: {e}')
        return None
 
-def wait_for_cluster_creation(cluster_id):
-    """Verifies if AWS Redshift Cluster was created
+def wait_for(check, timeout=None, initial_delay=None, max_delay=None, backoff=None):
+    """Polls a check with adaptive backoff until it returns something other than None
+
+    The delay starts short, so fast transitions are detected quickly, and grows by the backoff
+    factor up to max_delay for long ones. Defaults come from the PROVISIONING section of the cfg file.
+
+    Args:
+        check (function): Callable returning None while the resource is not ready
+        timeout (int): Seconds to wait before giving up
+        initial_delay (float): Seconds before the second check
+        max_delay (float): Maximum seconds between two checks
+        backoff (float): Factor the delay grows by after each check
+
+    Returns:
+        object: First value returned by check other than None
+    """
+    config = get_config()
+    timeout = timeout or config.getint('PROVISIONING', 'TIMEOUT', fallback=1800)
+    delay = initial_delay or config.getfloat('PROVISIONING', 'POLL_INITIAL_DELAY', fallback=5)
+    max_delay = max_delay or config.getfloat('PROVISIONING', 'POLL_MAX_DELAY', fallback=30)
+    backoff = backoff or config.getfloat('PROVISIONING', 'POLL_BACKOFF', fallback=1.5)
+
+    deadline = time.time() + timeout
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        if time.time() + delay > deadline:
+            raise TimeoutError('Resource not ready after {}s'.format(timeout))
+        time.sleep(delay)
+        delay = min(delay * backoff, max_delay)
+
+def wait_for_cluster_creation(cluster_id, timeout=None, max_delay=None):
+    """Verifies if AWS Redshift Cluster was created (or resumed)
 
     Args:
       cluster_id (string): AWS Redshift Cluster Name
+      timeout (int): Seconds to wait before giving up (defaults to TIMEOUT on the cfg file)
+      max_delay (float): Maximum seconds between two checks (defaults to POLL_MAX_DELAY on the cfg file)
 
     Returns:
       dictionary: AWS Redshift Cluster Information
     """
-    while True:
-        response = redshift_client.describe_clusters(ClusterIdentifier=cluster_id)
+    def check():
+        response = get_client('redshift').describe_clusters(ClusterIdentifier=cluster_id)
         cluster_info = response['Clusters'][0]
-        if cluster_info['ClusterStatus'] == 'available':
-            break
-        time.sleep(60)
+        return cluster_info if cluster_info['ClusterStatus'] == 'available' else None
+
+    return wait_for(check, timeout, max_delay=max_delay)
+
+def timed(timeline, resource, function, *args):
+    """Runs a provisioning step, recording when it started and finished on the timeline
+
+    Args:
+        timeline (dictionary): Resource name mapped to its start, end and duration
+        resource (string): Resource name
+        function (function): Provisioning step
+        *args: Arguments of the provisioning step
+
+    Returns:
+        object: Value returned by the provisioning step
+    """
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        end = time.time()
+        timeline[resource] = {'start': start, 'end': end, 'duration': round(end - start, 1)}
 
-    return cluster_info
+def print_timeline(timeline):
+    """Prints when each resource started and finished, relative to the first one
+
+    Args:
+        timeline (dictionary): Resource name mapped to its start, end and duration
+    """
+    if not timeline:
+        return
+    origin = min(item['start'] for item in timeline.values())
+    for resource, item in sorted(timeline.items(), key=lambda entry: entry[1]['start']):
+        print(f"{resource:<20} {item['start'] - origin:>7.1f}s -> {item['end'] - origin:>7.1f}s ({item['duration']}s)")
 
 def create_resources():
-    """Initiate Resources Creation"""
+    """Initiate Resources Creation
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    The IAM role, the security group and the WLM parameter group are created at the same time,
+    and the cluster is created (or resumed, if paused) as soon as they are ready.
 
-    iam_role = create_iam_role(config, s3_arn_policy)
-    cluster_sg_id = create_cluster_security_group()
-    cluster_info = create_redshift_cluster(config, iam_role['Role']['Arn'], cluster_sg_id)
+    Returns:
+        dictionary: Resource name mapped to its start, end and duration
+    """
+
+    config = get_config()
+
+    timeline = {}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        iam_role_future = executor.submit(timed, timeline, 'iam_role', create_iam_role, config, s3_arn_policy)
+        cluster_sg_future = executor.submit(timed, timeline, 'security_group', create_cluster_security_group)
+        parameter_group_future = executor.submit(timed, timeline, 'parameter_group', create_parameter_group, config)
+        iam_role = iam_role_future.result()
+        cluster_sg_id = cluster_sg_future.result()
+        parameter_group = parameter_group_future.result()
+
+    cluster_info = timed(timeline, 'cluster', create_redshift_cluster, config, iam_role['Role']['Arn'], cluster_sg_id, parameter_group)
 
     if cluster_info is not None:
         print(f'Creating cluster: {cluster_info["ClusterIdentifier"]}')
         print(f'Cluster status: {cluster_info["ClusterStatus"]}')
         print(f'Database name: {cluster_info["DBName"]}')
 
-        print('Waiting for cluster to be created...')
-        cluster_info = wait_for_cluster_creation(cluster_info['ClusterIdentifier'])
+        # A resumed cluster is ready within minutes, so it is polled more often
+        max_delay = None
+        if cluster_info['ClusterStatus'] == 'resuming':
+            max_delay = config.getfloat('PROVISIONING', 'RESUME_POLL_MAX_DELAY', fallback=10)
+
+        print('Waiting for cluster to be available...')
+        cluster_info = timed(timeline, 'cluster_available', wait_for_cluster_creation, cluster_info['ClusterIdentifier'], None, max_delay)
         print(f'Cluster created.')
         print(f"Endpoint={cluster_info['Endpoint']['Address']}")
 
@@ -213,5 +424,9 @@ def create_resources():
         update_config_file(config_file, 'SECURITY', 'SG_ID', cluster_sg_id)
         print('CFG file Updated.')
 
+    print('Provisioning timeline:')
+    print_timeline(timeline)
+    return timeline
+
 if __name__ == "__main__":
     create_resources()
\ No newline at end of file
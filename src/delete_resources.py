@@ -1,34 +1,27 @@
-import boto3
-import time
-import configparser
-from create_resources import config_file, s3_arn_policy
+import argparse
+from datetime import datetime
+from create_resources import s3_arn_policy, wait_for
+from settings import get_config, get_client
 
-# Reading cfg file
-config = configparser.ConfigParser()
-config.read(config_file)
-
-# Setting up Access Key and Secret Key
-KEY = config.get('AWS','KEY')
-SECRET = config.get('AWS','SECRET')
-
-# Define AWS Services
-redshift_client = boto3.client('redshift', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-iam_client = boto3.client('iam', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-ec2_client = boto3.client('ec2', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
-
-def delete_redshift_cluster(config):
+def delete_redshift_cluster(config, snapshot_id=None):
     """Deletes AWS Redshift Cluster
 
     Args:
         config (ConfigParser object): Configuration File to define Resource configuration
+        snapshot_id (string): Final snapshot taken before deleting the cluster (None skips it)
 
     Returns:
         dictionary: AWS Redshift Information
     """
+    if snapshot_id is None:
+        snapshot_options = {'SkipFinalClusterSnapshot': True}
+    else:
+        snapshot_options = {'SkipFinalClusterSnapshot': False, 'FinalClusterSnapshotIdentifier': snapshot_id}
+
     try:
-        response = redshift_client.delete_cluster(
+        response = get_client('redshift').delete_cluster(
             ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'),
-            SkipFinalClusterSnapshot=True
+            **snapshot_options
         )
     except:
         print("Redshift Cluster '%s' does not exist!" % (config.get('CLUSTER', 'CLUSTERIDENTIFIER')))
@@ -36,19 +29,75 @@ def delete_redshift_cluster(config):
     else:
         return response['Cluster']
 
-def wait_for_cluster_deletion(cluster_id):
+def wait_for_cluster_deletion(cluster_id, timeout=None):
     """Verifies if AWS Redshift Cluster was deleted
 
     Args:
         cluster_id (dictionary): AWS Redshift Cluster Information
+        timeout (int): Seconds to wait before giving up (defaults to TIMEOUT on the cfg file)
     """
-    while True:
+    def check():
+        try:
+            get_client('redshift').describe_clusters(ClusterIdentifier=cluster_id)
+        except:
+            return True
+        return None
+
+    wait_for(check, timeout)
+
+def prune_snapshots(config, keep):
+    """Deletes the oldest manual snapshots of the cluster, keeping the latest ones
+
+    Args:
+        config (ConfigParser object): Configuration File to define Resource configuration
+        keep (int): Number of snapshots to keep
+    """
+    try:
+        response = get_client('redshift').describe_cluster_snapshots(
+            ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'),
+            SnapshotType='manual'
+        )
+    except:
+        return
+
+    snapshots = sorted([snapshot for snapshot in response['Snapshots'] if snapshot['Status'] == 'available'],
+                       key=lambda snapshot: snapshot['SnapshotCreateTime'], reverse=True)
+    for snapshot in snapshots[keep:]:
         try:
-            redshift_client.describe_clusters(ClusterIdentifier=cluster_id)
+            get_client('redshift').delete_cluster_snapshot(SnapshotIdentifier=snapshot['SnapshotIdentifier'])
+            print(f"Snapshot {snapshot['SnapshotIdentifier']} deleted.")
         except:
-            break
-        else:
-            time.sleep(60)
+            print(f"Snapshot '{snapshot['SnapshotIdentifier']}' could not be deleted!")
+
+def pause_redshift_cluster(config):
+    """Pauses AWS Redshift Cluster, keeping its data
+
+    Args:
+        config (ConfigParser object): Configuration File to define Resource configuration
+
+    Returns:
+        dictionary: AWS Redshift Information
+    """
+    try:
+        response = get_client('redshift').pause_cluster(ClusterIdentifier=config.get('CLUSTER', 'CLUSTERIDENTIFIER'))
+    except:
+        print("Redshift Cluster '%s' does not exist or cannot be paused!" % (config.get('CLUSTER', 'CLUSTERIDENTIFIER')))
+        return None
+    else:
+        return response['Cluster']
+
+def wait_for_cluster_pause(cluster_id, timeout=None):
+    """Verifies if AWS Redshift Cluster was paused
+
+    Args:
+        cluster_id (string): AWS Redshift Cluster Name
+        timeout (int): Seconds to wait before giving up (defaults to TIMEOUT on the cfg file)
+    """
+    def check():
+        response = get_client('redshift').describe_clusters(ClusterIdentifier=cluster_id)
+        return True if response['Clusters'][0]['ClusterStatus'] == 'paused' else None
+
+    wait_for(check, timeout)
 
 def delete_iam_role(config, arn_policy):
     """Deletes AWS IAM Role
@@ -58,11 +107,11 @@ def delete_iam_role(config, arn_policy):
         arn_policy (string): ARN Policy you want to detach from the IAM Role
     """
     try:
-        iam_client.detach_role_policy(
+        get_client('iam').detach_role_policy(
             RoleName=config.get('SECURITY', 'ROLE_NAME'),
             PolicyArn=s3_arn_policy
         )
-        iam_client.delete_role(RoleName=config.get('SECURITY', 'ROLE_NAME'))
+        get_client('iam').delete_role(RoleName=config.get('SECURITY', 'ROLE_NAME'))
         print('IAM Role deleted.')
     except:
         print("IAM Role '%s' does not exist!" % (config.get('SECURITY', 'ROLE_NAME')))
@@ -74,18 +123,38 @@ def delete_security_group(config):
         config (ConfigParser object): Configuration File to define Resource configuration
     """
     try:
-        ec2_client.delete_security_group(GroupId=config.get('SECURITY', 'SG_ID'))
+        get_client('ec2').delete_security_group(GroupId=config.get('SECURITY', 'SG_ID'))
         print('Security Group deleted.')
     except:
         print("Security Group '%s' does not exist!" % (config.get('SECURITY', 'SG_ID')))
 
-def delete_resources():
-    """Initiate Resources Deletion"""
+def delete_parameter_group(config):
+    """Deletes the cluster parameter group holding the WLM configuration
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    Args:
+        config (ConfigParser object): Configuration File to define Resource configuration
+    """
+    if not config.getboolean('WLM', 'ENABLED', fallback=False):
+        return
+    try:
+        get_client('redshift').delete_cluster_parameter_group(ParameterGroupName=config.get('WLM', 'PARAMETER_GROUP'))
+        print('Parameter Group deleted.')
+    except:
+        print("Parameter Group '%s' does not exist!" % (config.get('WLM', 'PARAMETER_GROUP')))
 
-    cluster_info = delete_redshift_cluster(config)
+def delete_resources(snapshot_id=None):
+    """Initiate Resources Deletion
+
+    Args:
+        snapshot_id (string): Name of the final snapshot (defaults to a timestamped name when FINAL_SNAPSHOT is set on the cfg file)
+    """
+
+    config = get_config()
+
+    if snapshot_id is None and config.getboolean('SNAPSHOT', 'FINAL_SNAPSHOT', fallback=False):
+        snapshot_id = '{}-{}'.format(config.get('CLUSTER', 'CLUSTERIDENTIFIER'), datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+
+    cluster_info = delete_redshift_cluster(config, snapshot_id)
 
     if cluster_info is not None:
         print(f'Deleting Redshift cluster: {cluster_info["ClusterIdentifier"]}')
@@ -95,9 +164,61 @@ def delete_resources():
         wait_for_cluster_deletion(cluster_info['ClusterIdentifier'])
         print('Redshift Cluster deleted.')
 
+        if snapshot_id is not None:
+            print(f'Final snapshot taken: {snapshot_id}')
+            prune_snapshots(config, config.getint('SNAPSHOT', 'KEEP_SNAPSHOTS', fallback=2))
+
     delete_iam_role(config,s3_arn_policy)
 
     delete_security_group(config)
 
+    delete_parameter_group(config)
+
+def pause_resources():
+    """Pauses the Redshift cluster, keeping the IAM role and the security group for the next session"""
+
+    config = get_config()
+
+    cluster_info = pause_redshift_cluster(config)
+
+    if cluster_info is not None:
+        print(f'Pausing Redshift cluster: {cluster_info["ClusterIdentifier"]}')
+
+        print('Waiting for Redshift cluster to be paused...')
+        wait_for_cluster_pause(cluster_info['ClusterIdentifier'])
+        print('Redshift Cluster paused.')
+
+def get_exit_action():
+    """Returns what happens to the AWS resources when a session ends
+
+    Returns:
+        string: 'pause' or 'delete' (EXIT_ACTION on the cfg file)
+    """
+    config = get_config()
+    return config.get('ETL', 'EXIT_ACTION', fallback='delete')
+
+def get_exit_prompt():
+    """Returns the confirmation asked before ending a session
+
+    Returns:
+        string: Confirmation message
+    """
+    if get_exit_action() == 'pause':
+        return "This will pause the Redshift Cluster. Do you want to proceed? Please enter [y] or [n]: "
+    return "This will delete all AWS Resources. Do you want to proceed? Please enter [y] or [n]: "
+
+def shutdown_resources():
+    """Pauses or deletes the AWS resources, following EXIT_ACTION on the cfg file"""
+
+    if get_exit_action() == 'pause':
+        print('Pausing Resources...')
+        pause_resources()
+    else:
+        print('Deleting Resources...')
+        delete_resources()
+
 if __name__ == "__main__":
-    delete_resources()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Deletes the AWS resources of the data warehouse')
+    parser.add_argument('--snapshot', help='name of the final snapshot taken before deleting the cluster')
+    args = parser.parse_args()
+    delete_resources(args.snapshot)
\ No newline at end of file
@@ -1,11 +1,142 @@
-from create_resources import config_file, create_resources
-from sql_objects import create_connection, drop_tables, create_tables, load_staging_tables, insert_tables
-from delete_resources import delete_resources
-from validation import validation_queries
-import configparser
+from create_resources import create_resources
+from settings import config_file, get_config, update_config_file
+from sql_objects import get_staging_format, check_data_distribution, get_load_generation, unmatched_plays_report, get_pool, close_pool, drop_tables, create_tables, insert_tables, insert_tables_parallel, staging_tables, transform_tables, get_query_group, queue_wait_report, refresh_materialized_views
+from delete_resources import shutdown_resources, get_exit_prompt
+from validation import validation_queries, run_batch
+from incremental import run_incremental_load, list_staging_files, record_full_load, reset_load_state, warehouse_is_loaded
+from load_errors import load_staging_tables_checked, print_load_errors, write_load_error_report
+from instrumentation import start_run, finish_run
+from shadow import recreate_tables, build_and_swap
+from maintenance import run_maintenance
+import argparse
 import sys
 
-def etl():
+def print_load_results(results):
+    """Prints the status of each table loaded in parallel
+
+    Args:
+        results (list): Load status for each table
+    """
+    for result in results:
+        print(f"{result['table']}: {result['status']} in {result['duration']}s")
+        if result['error'] is not None:
+            print(f"ERROR loading {result['table']}: {result['error']}")
+
+def print_unmatched_plays(cur):
+    """Prints how many of the song plays staged by the run were matched to a song
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+    """
+    report = unmatched_plays_report(cur)
+    print(f"Song plays matched to a song: {report['plays'] - report['unmatched']} of {report['plays']} (match rate {report['match_rate']})")
+    for item in report['top_unmatched']:
+        print(f"Unmatched: {item['song']} by {item['artist']} ({item['plays']} plays)")
+
+def print_queue_wait_report():
+    """Prints how long queries waited in their WLM queue over the last day, per query group"""
+    try:
+        with get_pool().connection(get_query_group('interactive')) as (cur, conn):
+            report = queue_wait_report(cur)
+            conn.commit()
+    except Exception as e:
+        print(f'ERROR reading the WLM queue wait: {e}')
+        return
+    for item in report:
+        print(f"{item['query_group']} (queue {item['service_class']}): {item['queries']} queries, "
+              f"waited {item['avg_queue_seconds']}s on average and {item['max_queue_seconds']}s at most")
+
+def full_load(cur, conn, config):
+    """Drops and rebuilds every table from the whole S3 history
+
+    With FULL_LOAD = swap on the cfg file, the final tables are built into shadow tables and swapped in at the end,
+    so they stay readable during the whole load.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        config (ConfigParser object): Configuration File defining the ETL options
+
+    Returns:
+        boolean: Whether every table was loaded
+    """
+    # Swap mode builds the final tables aside, so only the staging tables are dropped
+    swap = config.get('ETL', 'FULL_LOAD', fallback='rebuild') == 'swap'
+    parallel = config.get('ETL', 'TRANSFORM_MODE', fallback='serial') == 'parallel'
+
+    if swap:
+        print('Recreating Staging Tables...')
+        recreate_tables(cur, conn, staging_tables + transform_tables)
+    else:
+        print('Dropping Tables...')
+        drop_tables(cur, conn)
+
+        print('Creating Tables...')
+        create_tables(cur, conn)
+
+    # Only the files listed before the COPY are recorded as loaded, files landing meanwhile are staged by the next run
+    staged_files = list_staging_files()
+
+    print('Loading Staging Tables...')
+    staging_results = load_staging_tables_checked(config.get('ETL', 'LOAD_MODE', fallback='serial') == 'parallel',
+                                                  staged_files=staged_files)
+    print_load_results(staging_results)
+    print_load_errors(staging_results)
+    error_report = write_load_error_report(staging_results, config.get('ETL', 'REPORT_DIR', fallback='reports'))
+    if error_report:
+        print(f'Load errors written to {error_report}')
+    skipped_files = [url for result in staging_results for url in result['skipped_files']]
+
+    success = all(result['status'] == 'success' for result in staging_results)
+    if swap:
+        print('Building Fact & Dimension Tables into shadow tables and swapping them in...')
+        results = build_and_swap(cur, conn, parallel)
+        print_load_results(results)
+        success = success and all(result['status'] == 'success' for result in results)
+    elif parallel:
+        print('Loading Fact & Dimension Tables...')
+        results = insert_tables_parallel()
+        print_load_results(results)
+        success = success and all(result['status'] == 'success' for result in results)
+    else:
+        print('Loading Fact & Dimension Tables...')
+        results = insert_tables(cur, conn)
+        print_load_results(results)
+        success = success and all(result['status'] == 'success' for result in results)
+
+    print_unmatched_plays(cur)
+
+    # A failed load leaves no files recorded, so the next run loads the whole history again instead of only new files
+    if success:
+        print('Recording loaded files...')
+        record_full_load(cur, conn, staged_files, skipped_files)
+    else:
+        print('Load failed, clearing the loaded files: the next run rebuilds the warehouse with a full load.')
+        reset_load_state(cur, conn)
+    return success
+
+def etl(mode=None, batch=None):
+    """Creates the AWS resources, loads the warehouse and runs the validation prompt
+
+    Args:
+        mode (string): 'full' drops and rebuilds every table, 'incremental' loads only new S3 files
+                       (defaults to MODE on the cfg file)
+        batch (list): Question numbers and/or SQL files run as a batch instead of the validation prompt,
+                      the resources are then shut down and the script exits with a non-zero status on failure
+    """
+
+    config = get_config()
+    forced_mode = mode is not None
+    mode = mode or config.get('ETL', 'MODE', fallback='full')
+
+    # Converted files keep their names across conversions, so new data is only picked up by a full load
+    incremental_supported = get_staging_format() == 'json'
+    if mode == 'incremental' and not incremental_supported:
+        if forced_mode:
+            print('ERROR: incremental loads need STAGING_FORMAT = json, use --mode full to load converted files.')
+            sys.exit(1)
+        print('Incremental loads need STAGING_FORMAT = json, running a full load of the converted files.')
+        mode = 'full'
 
     print('Creating Resources...')
     create_resources()
@@ -14,22 +145,84 @@ def etl():
     # Connecting to Redshift Cluster
     print('Initiate ETL...')
     print('Connecting to Redshift Cluster...')
-    cur, conn = create_connection()
+    with get_pool().connection(get_query_group('etl')) as (cur, conn):
 
-    print('Dropping Tables...')
-    drop_tables(cur, conn)
+        # A warehouse restored from a snapshot is already loaded, only new files need to be loaded
+        if mode == 'full' and not forced_mode and incremental_supported and warehouse_is_loaded(cur):
+            print('Warehouse is already loaded, switching to incremental mode (use --mode full to rebuild it).')
+            mode = 'incremental'
+        # An empty warehouse is built with a full load, one COPY per prefix instead of one COPY per S3 file
+        elif mode == 'incremental' and not warehouse_is_loaded(cur):
+            print('Warehouse is not loaded yet, switching to a full load.')
+            mode = 'full'
+        conn.commit()
 
-    print('Creating Tables...')
-    create_tables(cur, conn)
+        # Records every statement of the run
+        start_run(mode)
 
-    print('Loading Staging Tables...')
-    load_staging_tables(cur, conn)
+        # Questions 1 to 3 read the base tables until the materialized views are recreated or refreshed for this load
+        views_generation = config.get('ETL', 'VIEWS_GENERATION', fallback='-1')
+        update_config_file(config_file, 'ETL', 'VIEWS_GENERATION', '-1')
+
+        if mode == 'incremental':
+            print('Loading new files incrementally...')
+            results = run_incremental_load(cur, conn)
+            print_load_results(results)
+            if results:
+                print_unmatched_plays(cur)
+                conn.commit()
+            # A run with no new files succeeds without modifying any table
+            success = all(result['status'] == 'success' for result in results)
+            modified = len(results) > 0
+        else:
+            success = full_load(cur, conn, config)
+            modified = True
 
-    print('Loading Fact & Dimension Tables...')
-    insert_tables(cur, conn)
+        # Invalidates the cached validation results whenever a table may have changed, even on a partly failed load
+        if modified:
+            update_config_file(config_file, 'ETL', 'LOAD_GENERATION', str(get_load_generation() + 1))
+        else:
+            # No table changed, so the views are exactly as fresh as before the run
+            update_config_file(config_file, 'ETL', 'VIEWS_GENERATION', views_generation)
 
-    print('Closing Cluster Connection...')
-    conn.close()
+        if success:
+            # Views dropped by a full load are created again, the others are refreshed
+            if config.getboolean('ETL', 'MATERIALIZED_VIEWS', fallback=False):
+                print('Creating or refreshing materialized views...')
+                if refresh_materialized_views(cur, conn):
+                    update_config_file(config_file, 'ETL', 'VIEWS_GENERATION', str(get_load_generation()))
+
+        print('Running table maintenance...')
+        commands = run_maintenance(cur, conn)
+        if commands is None:
+            print('Table maintenance is disabled (ENABLED = false on the [MAINTENANCE] section).')
+        elif not commands:
+            print('No table needs VACUUM or ANALYZE.')
+
+        print('Checking data distribution of the validation queries...')
+        for question_number, steps in check_data_distribution(cur).items():
+            print(f"Query {question_number}: {', '.join(steps) if steps else 'no broadcast or redistribution'}")
+        conn.commit()
+
+    print('Returning Cluster Connection to the pool...')
+
+    print('WLM queue wait per query group:')
+    print_queue_wait_report()
+
+    report_path = finish_run(config.get('ETL', 'REPORT_DIR', fallback='reports'))
+    print(f'Run report written to {report_path}')
+
+    # Non-interactive runs answer the batch and shut down without prompting
+    if batch:
+        print('Running validation batch...')
+        try:
+            results = run_batch(batch)
+        except (OSError, ValueError) as e:
+            print(f'ERROR: {e}')
+            results = {'success': False}
+        close_pool()
+        shutdown_resources()
+        sys.exit(0 if success and results['success'] else 1)
 
     # Creates an empty list to validate inputs by user
     answer_list = ['Y','N']
@@ -39,12 +232,14 @@ def etl():
         try:
             answer = str(input("Would you like to run some validation queries? Please enter [y] or [n]: ")).upper()
             if answer == 'N':
-                answer = str(input("This will delete all AWS Resources. Do you want to proceed? Please enter [y] or [n]: ")).upper()
+                answer = str(input(get_exit_prompt())).upper()
                 if answer == 'Y':
+                    print('WLM queue wait per query group:')
+                    print_queue_wait_report()
 
-                    # Delete Resources before exit program.
-                    print('Deleting Resources...')
-                    delete_resources()
+                    # Close pooled connections and pause or delete Resources before exit program.
+                    close_pool()
+                    shutdown_resources()
 
                     # Exit Program
                     print('Exiting Script... Goodbye! \n')
@@ -63,4 +258,8 @@ def etl():
             print("Error! This is not a letter. Try again.")
 
 if __name__ == "__main__":
-    etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Loads the Sparkify data warehouse on Amazon Redshift')
+    parser.add_argument('--mode', choices=['full', 'incremental'], help='full rebuild or incremental load (defaults to MODE on dwh.cfg)')
+    parser.add_argument('--batch', nargs='+', metavar='ITEM', help='Question numbers (1 to 3) and/or SQL files to run after the load instead of the prompt')
+    args = parser.parse_args()
+    etl(args.mode, args.batch)
\ No newline at end of file
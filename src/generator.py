@@ -0,0 +1,343 @@
+import argparse
+import json
+import math
+import os
+import random
+import string
+from datetime import datetime, timedelta, timezone
+from settings import get_config
+
+# Size of the udacity-dend datasets, generated at scale factor 1
+base_sizes = {'songs': 14896, 'artists': 10025, 'users': 97, 'events': 8056}
+
+# Log keys in the order of the staging_events columns, as mapped by log_json_path.json
+log_json_keys = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+                 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+
+# Pages other than NextSong, with the share of events they get
+other_pages = [('Home', 0.08), ('Logout', 0.03), ('Login', 0.03), ('Settings', 0.02), ('Upgrade', 0.02), ('Help', 0.02)]
+
+words = ['love', 'night', 'fire', 'heart', 'rain', 'dream', 'city', 'blue', 'gold', 'road', 'star', 'ghost', 'river',
+         'summer', 'stone', 'light', 'shadow', 'wild', 'echo', 'glass', 'silver', 'storm', 'ocean', 'paper', 'midnight',
+         'electric', 'sugar', 'thunder', 'velvet', 'neon', 'broken', 'forever', 'dance', 'home', 'winter', 'empire']
+first_names = ['Walter', 'Kaylee', 'Lily', 'Jacob', 'Chloe', 'Aleena', 'Tegan', 'Ryan', 'Jayden', 'Mohammad', 'Sara',
+               'Matthew', 'Layla', 'Wyatt', 'Ava', 'Noah', 'Olivia', 'Liam', 'Emma', 'Lucas']
+last_names = ['Frye', 'Summers', 'Koch', 'Levine', 'Cuevas', 'Kirby', 'Smith', 'Rodriguez', 'Bell', 'Johnson', 'Lee',
+              'Garcia', 'Brown', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor', 'Clark', 'Hall']
+locations = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Chicago-Naperville-Elgin, IL-IN-WI',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Atlanta-Sandy Springs-Roswell, GA', 'Portland-South Portland, ME',
+             'Lansing-East Lansing, MI', 'Houston-The Woodlands-Sugar Land, TX']
+user_agents = [
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"'
+]
+
+def seeded_random(seed, kind, index):
+    """Returns a random generator dedicated to one entity, so it can be rebuilt anywhere from its index
+
+    Args:
+        seed (int): Seed of the dataset
+        kind (string): Entity kind (e.g. song, artist, user)
+        index (int): Entity index
+
+    Returns:
+        Random object: Random generator of the entity
+    """
+    return random.Random('{}-{}-{}'.format(seed, kind, index))
+
+def entity_id(prefix, rng):
+    """Returns an id shaped like the Million Song Dataset ids (e.g. SOMZWCG12A8C13C480)"""
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+def zipf_index(rng, n, skew):
+    """Draws an index in [0, n) with Zipfian popularity, index 0 being the most popular
+
+    Uses the inverse of the continuous approximation of the Zipf distribution, so no table of n weights is kept.
+
+    Args:
+        rng (Random object): Random generator
+        n (int): Number of items
+        skew (float): Zipf exponent (0 draws uniformly)
+
+    Returns:
+        int: Index drawn
+    """
+    u = rng.random()
+    if skew <= 0:
+        rank = 1 + u * n
+    elif skew == 1:
+        rank = (n + 1) ** u
+    else:
+        rank = ((((n + 1) ** (1 - skew)) - 1) * u + 1) ** (1 / (1 - skew))
+    return min(n - 1, int(rank) - 1)
+
+def build_artist(seed, index):
+    """Returns the attributes of an artist
+
+    Args:
+        seed (int): Seed of the dataset
+        index (int): Artist index
+
+    Returns:
+        dictionary: Artist id, name, location, latitude & longitude
+    """
+    rng = seeded_random(seed, 'artist', index)
+    located = rng.random() < 0.4
+    return {
+        'artist_id': entity_id('AR', rng),
+        'artist_name': '{} {} {}'.format(rng.choice(['The', 'DJ', 'Los', 'Big']), rng.choice(words).title(), index),
+        'artist_location': rng.choice(locations) if located else '',
+        'artist_latitude': round(rng.uniform(-60, 70), 5) if located else None,
+        'artist_longitude': round(rng.uniform(-160, 160), 5) if located else None
+    }
+
+def build_song(seed, index, artists, skew):
+    """Returns the JSON record of a song, with the same fields as the song dataset
+
+    Args:
+        seed (int): Seed of the dataset
+        index (int): Song index
+        artists (int): Number of artists
+        skew (float): Zipf exponent of the artist popularity
+
+    Returns:
+        dictionary: Song record
+    """
+    rng = seeded_random(seed, 'song', index)
+    artist = build_artist(seed, zipf_index(rng, artists, skew))
+    record = {'num_songs': 1, 'artist_id': artist['artist_id'], 'artist_latitude': artist['artist_latitude'],
+              'artist_longitude': artist['artist_longitude'], 'artist_location': artist['artist_location'],
+              'artist_name': artist['artist_name']}
+    record.update({
+        'song_id': entity_id('SO', rng),
+        'title': '{} {}'.format(' '.join(rng.choice(words) for _ in range(rng.randint(1, 3))).title(), index),
+        'duration': round(rng.uniform(90, 420), 5),
+        'year': rng.choice([0, rng.randint(1960, 2018)])
+    })
+    return record
+
+def build_user(seed, index, start, days):
+    """Returns the attributes of a user
+
+    Args:
+        seed (int): Seed of the dataset
+        index (int): User index
+        start (datetime): First day of the logs (UTC)
+        days (int): Number of days of logs
+
+    Returns:
+        dictionary: User attributes, including the day the user upgrades to the paid level (None if never)
+    """
+    rng = seeded_random(seed, 'user', index)
+    return {
+        'userId': str(index + 1),
+        'firstName': rng.choice(first_names),
+        'lastName': rng.choice(last_names),
+        'gender': rng.choice(['F', 'M']),
+        'location': rng.choice(locations),
+        'userAgent': rng.choice(user_agents),
+        'registration': float(int((start - timedelta(days=rng.randint(1, 120))).timestamp() * 1000)),
+        'upgrade_day': rng.randint(0, days) if rng.random() < 0.3 else None
+    }
+
+class JsonFileWriter:
+    """Writes JSON records to numbered files of at most records_per_file records, one record per line
+
+    Args:
+        path_of (function): Returns the path of a file from its number
+        records_per_file (int): Maximum number of records per file
+    """
+
+    def __init__(self, path_of, records_per_file):
+        self.path_of = path_of
+        self.records_per_file = max(1, records_per_file)
+        self.file = None
+        self.files = 0
+        self.records = 0
+
+    def write(self, record):
+        """Writes a single record, starting a new file when the current one is full"""
+        if self.file is None or self.records >= self.records_per_file:
+            self.close()
+            path = self.path_of(self.files)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, 'w')
+            self.files += 1
+            self.records = 0
+        self.file.write(json.dumps(record) + '\n')
+        self.records += 1
+
+    def close(self):
+        """Finishes the current file"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def song_file_path(song_dir, number):
+    """Returns the path of a song file, nested three letters deep like the song dataset"""
+    letters = string.ascii_uppercase
+    folders = [letters[number // 26 ** level % 26] for level in range(3)]
+    return os.path.join(song_dir, *folders, 'TR{}{:08d}.json'.format(''.join(folders), number))
+
+def generate_songs(song_dir, seed, songs, artists, skew, songs_per_file):
+    """Writes the song dataset
+
+    Args:
+        song_dir (string): Output directory
+        seed (int): Seed of the dataset
+        songs (int): Number of songs
+        artists (int): Number of artists
+        skew (float): Zipf exponent of the artist popularity
+        songs_per_file (int): Songs per file (the song dataset holds one)
+
+    Returns:
+        int: Number of files written
+    """
+    writer = JsonFileWriter(lambda number: song_file_path(song_dir, number), songs_per_file)
+    try:
+        for index in range(songs):
+            writer.write(build_song(seed, index, artists, skew))
+    finally:
+        writer.close()
+    return writer.files
+
+def generate_events(log_dir, seed, start, days, events, songs, artists, users, skew, events_per_file, unmatched_ratio):
+    """Writes the log dataset, one file (or more past events_per_file) per day with events in time order
+
+    Only the session state of each user is kept in memory, songs are rebuilt from their index when played.
+
+    Args:
+        log_dir (string): Output directory
+        seed (int): Seed of the dataset
+        start (datetime): First day of the logs
+        days (int): Number of days of logs
+        events (int): Number of events
+        songs (int): Number of songs
+        artists (int): Number of artists
+        users (int): Number of users
+        skew (float): Zipf exponent of the song & user popularity
+        events_per_file (int): Maximum number of events per file
+        unmatched_ratio (float): Share of played songs missing from the song dataset
+
+    Returns:
+        int: Number of files written
+    """
+    rng = seeded_random(seed, 'events', 0)
+    user_cache = {}
+    sessions = {}
+    files = 0
+    session_count = 0
+
+    for day in range(days):
+        day_start = start + timedelta(days=day)
+        day_events = events // days + (1 if day < events % days else 0)
+        name = day_start.strftime('%Y-%m-%d')
+
+        def path_of(number, day_start=day_start, name=name):
+            suffix = '' if number == 0 else '-{:04d}'.format(number)
+            return os.path.join(log_dir, day_start.strftime('%Y'), day_start.strftime('%m'), f'{name}-events{suffix}.json')
+
+        writer = JsonFileWriter(path_of, events_per_file)
+        ts = day_start.timestamp() * 1000
+        step = 86400000 / max(1, day_events)
+        try:
+            for _ in range(day_events):
+                ts += rng.expovariate(1 / step)
+                index = zipf_index(rng, users, skew)
+                if index not in user_cache:
+                    user_cache[index] = build_user(seed, index, start, days)
+                user = user_cache[index]
+
+                # A new session starts after 30 minutes of inactivity
+                session = sessions.get(index)
+                if session is None or ts - session['last_ts'] > 1800000:
+                    session_count += 1
+                    session = sessions[index] = {'id': session_count, 'item': 0, 'last_ts': ts}
+                session['last_ts'] = ts
+
+                page = 'NextSong'
+                draw = rng.random()
+                for other_page, share in other_pages:
+                    if draw < share:
+                        page = other_page
+                        break
+                    draw -= share
+
+                record = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'],
+                          'gender': user['gender'], 'itemInSession': session['item'], 'lastName': user['lastName'],
+                          'length': None,
+                          'level': 'paid' if user['upgrade_day'] is not None and day >= user['upgrade_day'] else 'free',
+                          'location': user['location'], 'method': 'PUT' if page == 'NextSong' else 'GET',
+                          'page': page, 'registration': user['registration'], 'sessionId': session['id'],
+                          'song': None, 'status': 200, 'ts': int(ts), 'userAgent': user['userAgent'],
+                          'userId': user['userId']}
+                if page == 'NextSong':
+                    if rng.random() < unmatched_ratio:
+                        song = build_song(seed, songs + rng.randrange(songs), artists, skew)
+                    else:
+                        song = build_song(seed, zipf_index(rng, songs, skew), artists, skew)
+                    record.update({'artist': song['artist_name'], 'song': song['title'], 'length': song['duration']})
+                elif page == 'Login':
+                    record.update({'auth': 'Logged Out', 'firstName': None, 'gender': None, 'lastName': None,
+                                   'location': None, 'registration': None, 'userAgent': None, 'userId': ''})
+                writer.write(record)
+                session['item'] += 1
+        finally:
+            writer.close()
+        files += writer.files
+    return files
+
+def write_jsonpaths(path):
+    """Writes the JSONPaths file mapping the log keys to the staging_events columns"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(key) for key in log_json_keys]}, f, indent=4)
+
+def generate_dataset(output_dir=None, scale_factor=None, skew=None, seed=None):
+    """Writes a synthetic Sparkify dataset: song files, daily log files and the log JSONPaths file
+
+    Every entity is derived from the seed and its index, so the same settings always produce the same files.
+
+    Args:
+        output_dir (string): Output directory (defaults to OUTPUT_DIR on the cfg file)
+        scale_factor (float): Size relative to the udacity-dend datasets (defaults to SCALE_FACTOR on the cfg file)
+        skew (float): Zipf exponent of the song, artist & user popularity (defaults to SKEW on the cfg file)
+        seed (int): Seed of the dataset (defaults to SEED on the cfg file)
+
+    Returns:
+        dictionary: Number of songs, events & files written
+    """
+    config = get_config()
+    output_dir = output_dir or config.get('GENERATOR', 'OUTPUT_DIR', fallback='data')
+    scale_factor = scale_factor if scale_factor is not None else config.getfloat('GENERATOR', 'SCALE_FACTOR', fallback=1)
+    skew = skew if skew is not None else config.getfloat('GENERATOR', 'SKEW', fallback=1.0)
+    seed = seed if seed is not None else config.getint('GENERATOR', 'SEED', fallback=42)
+    start = datetime.strptime(config.get('GENERATOR', 'START_DATE', fallback='2018-11-01'), '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    days = config.getint('GENERATOR', 'DAYS', fallback=30)
+
+    sizes = {name: max(1, math.ceil(size * scale_factor)) for name, size in base_sizes.items()}
+    print(f"Generating {sizes['songs']} songs, {sizes['artists']} artists, {sizes['users']} users "
+          f"and {sizes['events']} events (scale factor {scale_factor}, skew {skew}, seed {seed})...")
+
+    song_files = generate_songs(os.path.join(output_dir, 'song_data'), seed, sizes['songs'], sizes['artists'], skew,
+                                config.getint('GENERATOR', 'SONGS_PER_FILE', fallback=1))
+    log_files = generate_events(os.path.join(output_dir, 'log_data'), seed, start, days, sizes['events'], sizes['songs'],
+                                sizes['artists'], sizes['users'], skew,
+                                config.getint('GENERATOR', 'EVENTS_PER_FILE', fallback=100000),
+                                config.getfloat('GENERATOR', 'UNMATCHED_RATIO', fallback=0.1))
+    write_jsonpaths(os.path.join(output_dir, 'log_json_path.json'))
+
+    print(f'{song_files} song files and {log_files} log files written to {output_dir}')
+    return {'songs': sizes['songs'], 'events': sizes['events'], 'song_files': song_files, 'log_files': log_files}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic Sparkify dataset')
+    parser.add_argument('--output-dir', help='Output directory (defaults to OUTPUT_DIR on the cfg file)')
+    parser.add_argument('--scale-factor', type=float, help='Size relative to the udacity-dend datasets')
+    parser.add_argument('--skew', type=float, help='Zipf exponent of the popularity (0 is uniform)')
+    parser.add_argument('--seed', type=int, help='Seed of the dataset')
+    args = parser.parse_args()
+
+    generate_dataset(args.output_dir, args.scale_factor, args.skew, args.seed)
@@ -0,0 +1,197 @@
+from settings import get_config
+from manifest import list_prefix, build_manifest_batches
+from load_errors import load_staging_table, print_load_errors
+from sql_objects import (sql_tasks, staging_tables, transform_tables, incremental_sql_tasks,
+                         state_table_queries, get_staging_source, staging_copy, run_table_tasks, get_max_workers)
+
+def create_missing_tables(cur, conn):
+    """Creates the state, staging, fact & dimension tables that do not exist yet
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+    """
+    for query in state_table_queries:
+        cur.execute(query)
+
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")
+    existing = set(row[0] for row in cur.fetchall())
+    for table, task in sql_tasks.items():
+        if table not in existing:
+            print(f'Creating missing table {table}...')
+            cur.execute(task['create'])
+    conn.commit()
+
+def warehouse_is_loaded(cur):
+    """Checks whether the warehouse already holds a load, e.g. after restoring the cluster from a snapshot
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+
+    Returns:
+        boolean: Whether the load state and songplays tables exist and hold rows
+    """
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")
+    existing = set(row[0] for row in cur.fetchall())
+    if not {'etl_loaded_files', 'songplays'} <= existing:
+        return False
+    for table in ['etl_loaded_files', 'songplays']:
+        cur.execute(f'SELECT 1 FROM {table} LIMIT 1;')
+        if cur.fetchone() is None:
+            return False
+    return True
+
+def get_loaded_keys(cur):
+    """Returns the S3 files already loaded by previous runs
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+
+    Returns:
+        set: S3 urls already loaded
+    """
+    cur.execute("SELECT s3_key FROM etl_loaded_files;")
+    return set(row[0] for row in cur.fetchall())
+
+def record_loaded_keys(cur, keys, batch_size=500):
+    """Records S3 files as loaded (the caller commits)
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        keys (list): S3 urls loaded
+        batch_size (int): Number of rows per INSERT statement
+    """
+    keys = sorted(keys)
+    for i in range(0, len(keys), batch_size):
+        values = ','.join(cur.mogrify('(%s)', (key,)).decode() for key in keys[i:i + batch_size])
+        cur.execute('INSERT INTO etl_loaded_files (s3_key) VALUES ' + values + ';')
+
+def stage_new_files(cur, conn, new_keys):
+    """Loads only the given S3 files into the staging tables
+
+    Slice-balanced manifests are used when MANIFEST_PREFIX is set on the cfg file, otherwise each file is copied on its own.
+    Files rejected by a COPY are re-staged on their own, and skipped if they still fail (see load_errors.py).
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        new_keys (dictionary): Staging table name mapped to the new S3 files to load
+
+    Returns:
+        list: Load status for each staging table with new files
+    """
+    config = get_config()
+    use_manifest = config.get('S3', 'MANIFEST_PREFIX', fallback='') != ''
+
+    results = []
+    for table, objects in new_keys.items():
+        if not objects:
+            continue
+        print(f'Staging {len(objects)} new files into {table}...')
+        if use_manifest:
+            copies = build_manifest_batches(table, objects)
+        else:
+            copies = [(staging_copy(table, item['url']), [item]) for item in objects]
+        results.append(load_staging_table(cur, conn, table, copies))
+    return results
+
+def list_staging_files():
+    """Lists the S3 files of each staging table, ignoring any cached listing
+
+    Returns:
+        dictionary: Staging table name mapped to its S3 files
+    """
+    return {table: list_prefix(get_staging_source(table), refresh=True) for table in staging_tables}
+
+def list_new_keys(cur):
+    """Lists the S3 files not loaded yet for each staging table
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+
+    Returns:
+        dictionary: Staging table name mapped to its new S3 files
+    """
+    loaded = get_loaded_keys(cur)
+    return {table: [item for item in objects if item['url'] not in loaded]
+            for table, objects in list_staging_files().items()}
+
+def record_full_load(cur, conn, staged_files, skipped_files=()):
+    """Resets the incremental state after a full rebuild, marking the S3 files listed before staging as loaded
+
+    Files landing while the prefixes were copied are left out, so the next incremental run stages them
+    (the rows a prefix COPY already picked up are skipped then).
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        staged_files (dictionary): Staging table name mapped to its S3 files, listed before the staging tables were loaded
+        skipped_files (list): S3 files the load skipped, left to be staged again by the next incremental run
+    """
+    skipped_files = set(skipped_files)
+    for query in state_table_queries:
+        cur.execute(query)
+    cur.execute("DELETE FROM etl_loaded_files;")
+    for objects in staged_files.values():
+        record_loaded_keys(cur, [item['url'] for item in objects if item['url'] not in skipped_files])
+    conn.commit()
+
+def reset_load_state(cur, conn):
+    """Clears the incremental state after a failed full load, so the next run rebuilds the warehouse with a full load
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+    """
+    for query in state_table_queries:
+        cur.execute(query)
+    cur.execute("DELETE FROM etl_loaded_files;")
+    conn.commit()
+
+def run_incremental_load(cur, conn, max_workers=None):
+    """Stages only new S3 files, appends new songplays & time rows and merges changed dimension rows
+
+    The loaded files are only recorded when every table was loaded, so the files of a failed run are staged again
+    on the next run.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        max_workers (int): Maximum number of concurrent statements (defaults to MAX_PARALLEL_INSERTS on the cfg file)
+
+    Returns:
+        list: Load status for each fact & dimension table
+    """
+    if max_workers is None:
+        max_workers = get_max_workers('MAX_PARALLEL_INSERTS', len(incremental_sql_tasks))
+
+    create_missing_tables(cur, conn)
+
+    new_keys = list_new_keys(cur)
+    if not any(new_keys.values()):
+        print('No new files to load.')
+        return []
+
+    # Staging tables only hold the files of the current run, staging_song_keys keeps the keys of every song loaded
+    for table in staging_tables + transform_tables:
+        if table != 'staging_song_keys':
+            cur.execute(f'TRUNCATE {table};')
+    conn.commit()
+
+    staging_results = stage_new_files(cur, conn, new_keys)
+    print_load_errors(staging_results)
+    failed = [result for result in staging_results if result['status'] != 'success']
+    if failed:
+        return failed
+
+    # Skipped files are not recorded, so the next run stages them again
+    skipped_files = set(url for result in staging_results for url in result['skipped_files'])
+    if skipped_files:
+        print(f'{len(skipped_files)} files skipped, they will be staged again on the next run.')
+
+    results = run_table_tasks(list(incremental_sql_tasks), max_workers, incremental_sql_tasks, 'incremental')
+    if all(result['status'] == 'success' for result in results.values()):
+        record_loaded_keys(cur, [item['url'] for objects in new_keys.values() for item in objects
+                                 if item['url'] not in skipped_files])
+        conn.commit()
+    return list(results.values())
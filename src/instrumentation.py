@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+class RunReport:
+    """Structured record of every statement executed during an ETL run
+
+    Args:
+        mode (string): ETL mode of the run (full or incremental)
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.started_at = datetime.utcnow().isoformat()
+        self.start = time.time()
+        self.statements = []
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        """Adds a statement entry to the report"""
+        with self._lock:
+            self.statements.append(entry)
+
+    def to_dict(self):
+        """Returns the report as a json serializable dictionary"""
+        with self._lock:
+            statements = list(self.statements)
+        return {
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'duration': round(time.time() - self.start, 3),
+            'statements': statements
+        }
+
+    def write(self, report_dir):
+        """Writes the report as JSON to the report directory
+
+        Args:
+            report_dir (string): Directory the report is written to
+
+        Returns:
+            string: Path of the report
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, 'run-{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+# Report of the run in progress (None when statements are not being recorded)
+active_run = None
+
+def start_run(mode):
+    """Starts recording the statements of an ETL run
+
+    Args:
+        mode (string): ETL mode of the run
+
+    Returns:
+        RunReport: Report of the run
+    """
+    global active_run
+    active_run = RunReport(mode)
+    return active_run
+
+def finish_run(report_dir):
+    """Stops recording and writes the report of the run
+
+    Args:
+        report_dir (string): Directory the report is written to
+
+    Returns:
+        string: Path of the report (None if no run was being recorded)
+    """
+    global active_run
+    if active_run is None:
+        return None
+    path = active_run.write(report_dir)
+    active_run = None
+    return path
+
+def fetch_scalar(cur, query):
+    """Returns the first column of the first row of a query"""
+    cur.execute(query)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def instrumented_execute(cur, phase, name, query):
+    """Executes a statement, recording its duration, rows affected and Redshift query ID on the active run
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        phase (string): Pipeline phase (e.g. drop, create, load_staging, transform)
+        name (string): Statement name (usually the target table)
+        query (string): SQL statement
+    """
+    run = active_run
+    if run is None:
+        cur.execute(query)
+        return
+
+    entry = {'phase': phase, 'name': name, 'status': 'success', 'duration': None, 'rows': None,
+             'copy_rows': None, 'query_id': None, 'error': None}
+    start = time.time()
+    try:
+        cur.execute(query)
+        entry['duration'] = round(time.time() - start, 3)
+        entry['rows'] = cur.rowcount if cur.rowcount >= 0 else None
+        entry['query_id'] = fetch_scalar(cur, 'SELECT pg_last_query_id();')
+        if re.match(r'\s*COPY\b', query, re.IGNORECASE):
+            entry['copy_rows'] = fetch_scalar(cur, 'SELECT pg_last_copy_count();')
+    except Exception as e:
+        entry['duration'] = round(time.time() - start, 3)
+        entry['status'] = 'failed'
+        entry['error'] = str(e).strip()
+        raise
+    finally:
+        run.add(entry)
+
+def compare_reports(baseline, current, threshold=1.2):
+    """Compares two run reports statement by statement
+
+    Args:
+        baseline (dictionary): Report of the reference run
+        current (dictionary): Report of the run to check
+        threshold (float): Duration ratio above which a statement is flagged as a regression
+
+    Returns:
+        list: Dictionaries with the durations, rows and ratio of each statement found on both runs
+    """
+    def totals(report):
+        result = {}
+        for entry in report['statements']:
+            key = (entry['phase'], entry['name'])
+            item = result.setdefault(key, {'duration': 0.0, 'rows': 0})
+            item['duration'] += entry['duration'] or 0
+            item['rows'] += entry['copy_rows'] if entry['copy_rows'] is not None else (entry['rows'] or 0)
+        return result
+
+    before, after = totals(baseline), totals(current)
+    comparison = []
+    for key in sorted(set(before) | set(after)):
+        old, new = before.get(key), after.get(key)
+        ratio = round(new['duration'] / old['duration'], 2) if old and new and old['duration'] > 0 else None
+        comparison.append({
+            'phase': key[0],
+            'name': key[1],
+            'baseline_duration': round(old['duration'], 3) if old else None,
+            'current_duration': round(new['duration'], 3) if new else None,
+            'baseline_rows': old['rows'] if old else None,
+            'current_rows': new['rows'] if new else None,
+            'ratio': ratio,
+            'regression': ratio is not None and ratio > threshold
+        })
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two ETL run reports')
+    parser.add_argument('baseline', help='Report of the reference run')
+    parser.add_argument('current', help='Report of the run to check')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Duration ratio flagged as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    comparison = compare_reports(baseline, current, args.threshold)
+    for item in comparison:
+        flag = 'REGRESSION' if item['regression'] else ''
+        print('{:<14} {:<20} {:>10} {:>10} {:>6} {:>12} {:>12} {}'.format(
+            item['phase'], item['name'], str(item['baseline_duration']), str(item['current_duration']),
+            str(item['ratio']), str(item['baseline_rows']), str(item['current_rows']), flag))
+    print('Total: {}s -> {}s'.format(baseline['duration'], current['duration']))
+    sys.exit(1 if any(item['regression'] for item in comparison) else 0)
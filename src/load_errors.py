@@ -0,0 +1,266 @@
+import json
+import os
+import time
+from datetime import datetime
+from settings import get_config
+from scheduler import run_task_graph
+from instrumentation import instrumented_execute
+from sql_objects import staging_tables, staging_copy, get_staging_source, get_pool, get_query_group, get_max_workers
+from manifest import list_prefix, build_manifest_batches, write_manifest
+
+# Rows rejected by a COPY, with the file, line & column they were read from
+load_errors_query = ("""
+    SELECT TRIM(filename), line_number, TRIM(colname), TRIM(type), err_code, TRIM(err_reason), TRIM(raw_field_value)
+    FROM stl_load_errors
+    WHERE query = %s
+    ORDER BY filename, line_number
+    LIMIT %s;
+""")
+
+# Number of rejected rows of each file of a COPY
+load_error_files_query = ("""
+    SELECT TRIM(filename), COUNT(1)
+    FROM stl_load_errors
+    WHERE query = %s
+    GROUP BY 1;
+""")
+
+# Lines scanned from each file a COPY committed
+load_commits_query = ("""
+    SELECT TRIM(filename), SUM(lines_scanned)
+    FROM stl_load_commits
+    WHERE query = %s
+    GROUP BY 1;
+""")
+
+def get_copy_summary(cur, query_id, max_errors=None):
+    """Reads what a COPY loaded and rejected from stl_load_commits & stl_load_errors
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        query_id (int): Query ID of the COPY (pg_last_copy_id())
+        max_errors (int): Maximum number of rejected rows reported (defaults to MAX_REPORTED_ERRORS on the cfg file)
+
+    Returns:
+        dictionary: Files committed, lines scanned, rejected rows per file and the first rejected rows
+    """
+    if max_errors is None:
+        max_errors = get_config().getint('LOAD', 'MAX_REPORTED_ERRORS', fallback=20)
+
+    cur.execute(load_commits_query, (query_id,))
+    commits = cur.fetchall()
+    cur.execute(load_error_files_query, (query_id,))
+    failed_files = {filename: count for filename, count in cur.fetchall()}
+    cur.execute(load_errors_query, (query_id, max_errors))
+    errors = [{'file': filename, 'line': line, 'column': column, 'type': column_type, 'code': code,
+               'reason': reason, 'raw_value': raw_value}
+              for filename, line, column, column_type, code, reason, raw_value in cur.fetchall()]
+
+    return {'query_id': query_id, 'files_committed': len(commits),
+            'lines_scanned': sum(int(lines or 0) for _, lines in commits),
+            'error_count': sum(failed_files.values()), 'failed_files': failed_files, 'errors': errors}
+
+def run_copy(cur, conn, table, query):
+    """Runs a COPY in its own transaction and reads its error summary, whether it succeeded or not
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        table (string): Staging table name
+        query (string): COPY statement
+
+    Returns:
+        dictionary: COPY status, duration, error message (if any) and summary (None if it could not be read)
+    """
+    result = {'table': table, 'status': 'success', 'duration': None, 'error': None, 'summary': None}
+    cur.execute('SELECT pg_last_copy_id();')
+    previous_id = cur.fetchone()[0]
+    conn.commit()
+
+    start = time.time()
+    try:
+        instrumented_execute(cur, 'load_staging', table, query)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        result['status'] = 'failed'
+        result['error'] = str(e).strip()
+    result['duration'] = round(time.time() - start, 3)
+
+    # A failed COPY keeps its query ID, so its rejected rows can still be read once the transaction is rolled back
+    try:
+        cur.execute('SELECT pg_last_copy_id();')
+        query_id = cur.fetchone()[0]
+        if query_id is not None and query_id > 0 and query_id != previous_id:
+            result['summary'] = get_copy_summary(cur, query_id)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f'ERROR reading the load errors of {table}: {e}')
+    return result
+
+def restage_files(cur, conn, table, objects, client=None):
+    """Loads a set of files again through a manifest written to RETRY_PREFIX (or MANIFEST_PREFIX) on the cfg file
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        table (string): Staging table name
+        objects (list): Dictionaries with the 'url' and 'size' of each file to load
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+
+    Returns:
+        dictionary: Status, error message, COPY summaries and files rejected by the manifest COPY
+    """
+    config = get_config()
+    prefix = config.get('LOAD', 'RETRY_PREFIX', fallback='') or config.get('S3', 'MANIFEST_PREFIX', fallback='')
+    restaged = {'status': 'success', 'error': None, 'summaries': [], 'rejected': set()}
+
+    # Copying the files one by one would take one COPY per file of the prefix
+    if not prefix:
+        restaged['status'] = 'failed'
+        restaged['error'] = ('Cannot re-stage the {} other files of {}: set RETRY_PREFIX on the [LOAD] section '
+                             '(or MANIFEST_PREFIX on the [S3] section) to an S3 prefix you can write to'.format(len(objects), table))
+        return restaged
+
+    manifest_url = '{}/{}-retry-{}.manifest'.format(prefix.rstrip('/'), table, datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'))
+    write_manifest(objects, manifest_url, client)
+    attempt = run_copy(cur, conn, table, staging_copy(table, manifest_url, manifest=True))
+    restaged['summaries'].append(attempt['summary'])
+    if attempt['status'] != 'success':
+        restaged['status'], restaged['error'] = 'failed', attempt['error']
+        restaged['rejected'] = set(attempt['summary']['failed_files']) if attempt['summary'] else set()
+    return restaged
+
+def load_staging_table(cur, conn, table, copies, client=None):
+    """Loads a staging table, re-staging only the files rejected by a failed COPY
+
+    When a COPY fails because of some of its files (e.g. one corrupt JSON file), the other files are loaded again
+    and each rejected file is retried once on its own. A COPY stops at its MAXERROR + 1th rejected row, so a re-staging
+    pass may reject more files: they are set aside the same way, up to MAX_RETRY_PASSES passes.
+    Files still failing are skipped and reported.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        table (string): Staging table name
+        copies (list): (COPY statement, files it loads) tuples, the files being listed on demand when None
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+
+    Returns:
+        dictionary: Load status, duration, error message, COPY summaries and skipped files of the table
+    """
+    config = get_config()
+    retry = config.getboolean('LOAD', 'RETRY_FAILED_FILES', fallback=True)
+    max_passes = config.getint('LOAD', 'MAX_RETRY_PASSES', fallback=5)
+    result = {'table': table, 'status': 'success', 'duration': None, 'error': None, 'summaries': [], 'skipped_files': []}
+    start = time.time()
+
+    for query, objects in copies:
+        attempt = run_copy(cur, conn, table, query)
+        result['summaries'].append(attempt['summary'])
+        if attempt['status'] == 'success':
+            continue
+
+        failed = set(attempt['summary']['failed_files']) if attempt['summary'] else set()
+        if not retry or not failed:
+            result['status'], result['error'] = 'failed', attempt['error']
+            break
+
+        if objects is None:
+            objects = list_prefix(get_staging_source(table), client)
+        for restage_pass in range(1, max_passes + 1):
+            healthy = [item for item in objects if item['url'] not in failed]
+            print(f'{table}: {len(failed)} files rejected, re-staging the other {len(healthy)} files (pass {restage_pass})...')
+            if not healthy:
+                break
+            restaged = restage_files(cur, conn, table, healthy, client)
+            result['summaries'].extend(restaged['summaries'])
+            if restaged['status'] == 'success':
+                break
+            if not restaged['rejected'] - failed or restage_pass == max_passes:
+                result['status'], result['error'] = 'failed', restaged['error']
+                break
+            failed |= restaged['rejected']
+        if result['status'] != 'success':
+            break
+
+        for url in sorted(failed):
+            attempt = run_copy(cur, conn, table, staging_copy(table, url))
+            result['summaries'].append(attempt['summary'])
+            if attempt['status'] != 'success':
+                result['skipped_files'].append(url)
+
+    result['summaries'] = [summary for summary in result['summaries'] if summary is not None]
+    result['duration'] = round(time.time() - start, 3)
+    return result
+
+def load_staging_tables_checked(parallel=True, max_workers=None, client=None, staged_files=None):
+    """Load data into staging tables on Redshift, capturing the load errors and re-staging only the rejected files
+
+    Every staging table is loaded over its own pooled connection, from slice-balanced manifests when MANIFEST_PREFIX
+    is set on the cfg file and from its S3 prefix otherwise.
+
+    Args:
+        parallel (boolean): Whether to load the staging tables at the same time
+        max_workers (int): Maximum number of tables loaded at the same time (defaults to MAX_PARALLEL_COPIES on the cfg file)
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+        staged_files (dictionary): Staging table name mapped to the S3 files the manifests list (listed when None)
+
+    Returns:
+        list: Load status for each staging table (see load_staging_table)
+    """
+    config = get_config()
+    if max_workers is None:
+        max_workers = get_max_workers('MAX_PARALLEL_COPIES', len(staging_tables)) if parallel else 1
+
+    copies = {}
+    for table in staging_tables:
+        if config.get('S3', 'MANIFEST_PREFIX', fallback='') != '':
+            objects = staged_files[table] if staged_files is not None else list_prefix(get_staging_source(table), client)
+            copies[table] = build_manifest_batches(table, objects, client)
+            print(f'{table}: {len(objects)} files in {len(copies[table])} manifests')
+        else:
+            copies[table] = [(staging_copy(table), None)]
+
+    def load(table):
+        with get_pool().connection(get_query_group('etl')) as (cur, conn):
+            return load_staging_table(cur, conn, table, copies[table], client)
+
+    results = run_task_graph({table: {'upstream': []} for table in staging_tables}, load, max_workers)
+    return [results[table] for table in staging_tables]
+
+def print_load_errors(results):
+    """Prints the rejected rows and skipped files of each staging table
+
+    Args:
+        results (list): Load status for each staging table
+    """
+    for result in results:
+        error_count = sum(summary['error_count'] for summary in result.get('summaries', []))
+        if error_count:
+            print(f"{result['table']}: {error_count} rows rejected")
+        for summary in result.get('summaries', []):
+            for error in summary['errors']:
+                print(f"  {error['file']} line {error['line']} ({error['column']}): {error['reason']} [{error['raw_value']}]")
+        for url in result.get('skipped_files', []):
+            print(f"  Skipped {url}")
+
+def write_load_error_report(results, report_dir):
+    """Writes the COPY summaries of a load as JSON when a row was rejected or a file skipped
+
+    Args:
+        results (list): Load status for each staging table
+        report_dir (string): Directory the report is written to
+
+    Returns:
+        string: Path of the report (None if the load had no errors)
+    """
+    if not any(result.get('skipped_files') or any(summary['error_count'] for summary in result.get('summaries', []))
+               for result in results):
+        return None
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, 'load-errors-{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    return path
@@ -0,0 +1,94 @@
+from settings import get_config
+from instrumentation import instrumented_execute
+from sql_objects import staging_tables, transform_tables
+
+# Statistics, unsorted & deleted row percentages of each table (svv_table_info only lists tables holding rows)
+table_health_query = ("""
+    SELECT "table",
+           COALESCE(stats_off, 0),
+           COALESCE(unsorted, 0),
+           CASE WHEN tbl_rows > 0 THEN 100.0 * (tbl_rows - estimated_visible_rows) / tbl_rows ELSE 0 END
+    FROM svv_table_info
+    WHERE "schema" = 'public';
+""")
+
+def get_table_health(cur):
+    """Reads how stale the statistics and how unsorted & bloated each table is
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+
+    Returns:
+        dictionary: Table name mapped to its stats_off, unsorted & deleted percentages
+    """
+    cur.execute(table_health_query)
+    return {table.strip(): {'stats_off': float(stats_off), 'unsorted': float(unsorted), 'deleted': float(deleted)}
+            for table, stats_off, unsorted, deleted in cur.fetchall()}
+
+def plan_maintenance(health, analyze_threshold, sort_threshold, delete_threshold, skip=()):
+    """Picks the VACUUM & ANALYZE commands of the tables past the thresholds
+
+    Args:
+        health (dictionary): Table name mapped to its stats_off, unsorted & deleted percentages
+        analyze_threshold (float): stats_off percentage above which a table is analyzed
+        sort_threshold (float): Unsorted percentage above which a table is sorted
+        delete_threshold (float): Deleted rows percentage above which a table's space is reclaimed
+        skip (list): Tables never maintained (e.g. staging tables, dropped on every load)
+
+    Returns:
+        list: (table, command, reason) tuples, VACUUMs first since they change the statistics
+    """
+    vacuums, analyzes = [], []
+    for table in sorted(health):
+        if table in skip:
+            continue
+        item = health[table]
+        needs_sort = item['unsorted'] > sort_threshold
+        needs_delete = item['deleted'] > delete_threshold
+        if needs_sort and needs_delete:
+            vacuums.append((table, f'VACUUM FULL {table};', f"{item['unsorted']:.1f}% unsorted, {item['deleted']:.1f}% deleted"))
+        elif needs_sort:
+            vacuums.append((table, f'VACUUM SORT ONLY {table};', f"{item['unsorted']:.1f}% unsorted"))
+        elif needs_delete:
+            vacuums.append((table, f'VACUUM DELETE ONLY {table};', f"{item['deleted']:.1f}% deleted"))
+        if item['stats_off'] > analyze_threshold:
+            analyzes.append((table, f'ANALYZE {table};', f"statistics {item['stats_off']:.1f}% off"))
+    return vacuums + analyzes
+
+def run_maintenance(cur, conn):
+    """Runs VACUUM & ANALYZE only on the tables past the thresholds of the [MAINTENANCE] section
+
+    VACUUM cannot run inside a transaction, so the commands run in autocommit mode.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+
+    Returns:
+        list: (table, command, reason) tuples of the commands run (None if maintenance is disabled on the cfg file)
+    """
+    config = get_config()
+    if not config.getboolean('MAINTENANCE', 'ENABLED', fallback=True):
+        return None
+
+    health = get_table_health(cur)
+    conn.commit()
+    commands = plan_maintenance(
+        health,
+        config.getfloat('MAINTENANCE', 'ANALYZE_THRESHOLD', fallback=10),
+        config.getfloat('MAINTENANCE', 'SORT_THRESHOLD', fallback=10),
+        config.getfloat('MAINTENANCE', 'DELETE_THRESHOLD', fallback=5),
+        staging_tables + transform_tables
+    )
+
+    conn.autocommit = True
+    try:
+        for table, command, reason in commands:
+            print(f'{command} ({reason})')
+            try:
+                instrumented_execute(cur, 'maintenance', table, command)
+            except Exception as e:
+                print(e)
+    finally:
+        conn.autocommit = False
+    return commands
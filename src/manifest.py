@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import time
+from settings import get_config, get_client
+from sql_objects import staging_suffixes, get_staging_format, staging_copy
+
+# Number of slices per node for each Redshift node type
+node_slices = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16
+}
+
+# In-memory cache of S3 listings, keyed by S3 prefix
+listing_cache = {}
+
+def split_s3_url(s3_url):
+    """Splits an S3 url into bucket and key
+
+    Args:
+        s3_url (string): S3 url (e.g. s3://bucket/prefix/)
+
+    Returns:
+        tuple: Bucket name and key (or prefix)
+    """
+    bucket, _, key = s3_url.replace('s3://', '', 1).partition('/')
+    return bucket, key
+
+def list_prefix(s3_url, client=None, cache_file=None, max_age=None, refresh=False, suffix=None):
+    """Lists every data file under an S3 prefix once, caching the listing in memory and on disk
+
+    Args:
+        s3_url (string): S3 prefix (e.g. s3://udacity-dend/song_data/)
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+        cache_file (string): JSON file the listing is cached to (defaults to LISTING_CACHE on the cfg file, empty disables it)
+        max_age (int): Seconds a cached listing is considered fresh (defaults to LISTING_CACHE_MAX_AGE on the cfg file)
+        refresh (boolean): Whether to ignore the cache and list the prefix again
+        suffix (string): Suffix of the data files (defaults to the one of STAGING_FORMAT on the cfg file)
+
+    Returns:
+        list: Dictionaries with the 'url' and 'size' of each data file found
+    """
+    config = get_config()
+    if suffix is None:
+        suffix = staging_suffixes[get_staging_format()]
+    if cache_file is None:
+        cache_file = config.get('S3', 'LISTING_CACHE', fallback='')
+    if max_age is None:
+        max_age = config.getint('S3', 'LISTING_CACHE_MAX_AGE', fallback=3600)
+
+    if not refresh and s3_url in listing_cache and time.time() - listing_cache[s3_url]['listed_at'] <= max_age:
+        return listing_cache[s3_url]['objects']
+
+    disk_cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            disk_cache = json.load(f)
+        if not refresh and s3_url in disk_cache and time.time() - disk_cache[s3_url]['listed_at'] <= max_age:
+            listing_cache[s3_url] = disk_cache[s3_url]
+            return disk_cache[s3_url]['objects']
+
+    client = client or get_client('s3')
+    bucket, prefix = split_s3_url(s3_url)
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].endswith(suffix):
+                objects.append({'url': 's3://{}/{}'.format(bucket, item['Key']), 'size': item['Size']})
+
+    listing_cache[s3_url] = {'listed_at': time.time(), 'objects': objects}
+    if cache_file:
+        disk_cache[s3_url] = listing_cache[s3_url]
+        with open(cache_file, 'w') as f:
+            json.dump(disk_cache, f)
+    return objects
+
+def get_slice_count(config):
+    """Returns the number of slices of the cluster
+
+    Args:
+        config (ConfigParser object): Configuration File defining NODETYPE and NUMBEROFNODES
+
+    Returns:
+        int: Number of slices
+    """
+    nodes = config.getint('CLUSTER', 'NUMBEROFNODES') if config.get('CLUSTER', 'CLUSTERTYPE') == 'multi-node' else 1
+    return node_slices.get(config.get('CLUSTER', 'NODETYPE'), 2) * nodes
+
+def balance_batches(objects, slices, max_batch_bytes):
+    """Groups files into batches of similar total size, each with enough files to keep every slice busy
+
+    The number of batches is the smallest one keeping every batch under max_batch_bytes,
+    capped so every batch still holds at least one file per slice. Files are then assigned
+    largest first to the lightest batch.
+
+    Args:
+        objects (list): Dictionaries with the 'url' and 'size' of each file
+        slices (int): Number of slices of the cluster
+        max_batch_bytes (int): Target maximum size of a batch
+
+    Returns:
+        list: Batches, each a list of file dictionaries
+    """
+    if not objects:
+        return []
+
+    total_bytes = sum(item['size'] for item in objects)
+    batch_count = max(1, math.ceil(total_bytes / max(1, max_batch_bytes)))
+    batch_count = max(1, min(batch_count, len(objects) // max(1, slices)))
+
+    batches = [[] for _ in range(batch_count)]
+    batch_bytes = [0] * batch_count
+    for item in sorted(objects, key=lambda item: item['size'], reverse=True):
+        lightest = batch_bytes.index(min(batch_bytes))
+        batches[lightest].append(item)
+        batch_bytes[lightest] += item['size']
+    return batches
+
+def write_manifest(objects, manifest_url, client=None):
+    """Writes a COPY manifest listing the given files
+
+    Args:
+        objects (list): Dictionaries with the 'url' and 'size' of each file
+        manifest_url (string): S3 url the manifest is written to
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+
+    Returns:
+        string: S3 url of the manifest
+    """
+    client = client or get_client('s3')
+    bucket, key = split_s3_url(manifest_url)
+    manifest = {'entries': [{'url': item['url'], 'mandatory': True, 'meta': {'content_length': item['size']}}
+                            for item in objects]}
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    return manifest_url
+
+def build_manifest_batches(table, objects, client=None):
+    """Writes slice-balanced manifests for a staging table and returns the COPY statement & files of each batch
+
+    Args:
+        table (string): Staging table name
+        objects (list): Dictionaries with the 'url' and 'size' of each file to load
+        client (boto3 client): S3 client (defaults to the shared S3 client)
+
+    Returns:
+        list: (COPY statement in MANIFEST form, files of the batch) tuples, one per batch
+    """
+    config = get_config()
+
+    prefix = config.get('S3', 'MANIFEST_PREFIX').rstrip('/')
+    max_batch_bytes = config.getint('S3', 'MANIFEST_MAX_BATCH_MB', fallback=1024) * 1024 * 1024
+    batches = balance_batches(objects, get_slice_count(config), max_batch_bytes)
+
+    copies = []
+    for i, batch in enumerate(batches):
+        manifest_url = write_manifest(batch, '{}/{}-{:04d}.manifest'.format(prefix, table, i), client)
+        copies.append((staging_copy(table, manifest_url, manifest=True), batch))
+    return copies
@@ -0,0 +1,125 @@
+import re
+from settings import get_config
+from sql_objects import get_pool, get_query_group
+
+# Plan node line of a Redshift EXPLAIN (e.g. "->  XN Hash Join DS_BCAST_INNER  (cost=0.00..1000.25 rows=10 width=20)")
+plan_node = re.compile(r'^(\s*)(?:->\s*)?(.+?)\s+\(cost=([\d.]+)\.\.([\d.]+) rows=(\d+) width=(\d+)\)')
+
+# Steps flagged by default: joins without a usable join condition, and joins moving whole tables between nodes
+default_flag_steps = ['Nested Loop', 'DS_BCAST_INNER', 'DS_DIST_BOTH']
+
+guard_policies = ('refuse', 'warn', 'limit', 'timeout')
+
+def parse_plan(lines):
+    """Parses the nodes of an EXPLAIN output
+
+    Args:
+        lines (list): Lines of the EXPLAIN output
+
+    Returns:
+        list: Plan nodes (operation, depth, startup & total cost, rows), top node first
+    """
+    steps = []
+    for line in lines:
+        match = plan_node.match(line)
+        if match:
+            steps.append({'operation': match.group(2).strip(), 'depth': len(match.group(1)),
+                          'startup_cost': float(match.group(3)), 'total_cost': float(match.group(4)),
+                          'rows': int(match.group(5))})
+    return steps
+
+def inspect_plan(steps, cost_threshold, flag_steps=None):
+    """Flags the expensive steps of a query plan
+
+    Args:
+        steps (list): Plan nodes returned by parse_plan
+        cost_threshold (float): Total plan cost above which the query is flagged (0 means no limit)
+        flag_steps (list): Operations flagged wherever they appear (defaults to nested loops, DS_BCAST_INNER & DS_DIST_BOTH)
+
+    Returns:
+        list: Reasons the query was flagged (empty if the plan looks safe)
+    """
+    flag_steps = default_flag_steps if flag_steps is None else flag_steps
+    flags = []
+    for step in flag_steps:
+        matches = [node for node in steps if step.lower() in node['operation'].lower()]
+        if matches:
+            flags.append('{} step ({} rows estimated)'.format(step, max(node['rows'] for node in matches)))
+    total_cost = steps[0]['total_cost'] if steps else 0
+    if cost_threshold and total_cost > cost_threshold:
+        flags.append('plan cost {:.0f} above {:.0f}'.format(total_cost, cost_threshold))
+    return flags
+
+def explain_query(query):
+    """Runs EXPLAIN on a query over a pooled connection
+
+    Args:
+        query (string): SQL Query
+
+    Returns:
+        list: Lines of the EXPLAIN output
+    """
+    with get_pool().connection(get_query_group('interactive')) as (cur, conn):
+        cur.execute('EXPLAIN ' + query)
+        lines = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    return lines
+
+def is_select(query):
+    """Checks whether a statement is a SELECT (possibly starting with a WITH clause)"""
+    return re.match(r'\s*(?:SELECT|WITH)\b', query, re.IGNORECASE) is not None
+
+def limit_query(query, limit):
+    """Wraps a SELECT so it returns at most limit rows"""
+    return 'SELECT * FROM ({}) AS guarded LIMIT {}'.format(query.strip().rstrip(';'), int(limit))
+
+def guard_query(query, policy=None):
+    """Inspects the plan of a custom query before it runs and applies the policy of the [GUARD] section
+
+    Policies:
+        refuse: flagged queries are not run
+        warn: flagged queries run after printing why they were flagged
+        limit: flagged SELECTs are wrapped with LIMIT_ROWS, other statements get STATEMENT_TIMEOUT
+        timeout: flagged queries are cancelled after STATEMENT_TIMEOUT milliseconds
+
+    Args:
+        query (string): SQL Query
+        policy (string): refuse, warn, limit or timeout (defaults to POLICY on the cfg file)
+
+    Returns:
+        dictionary: Query to run (None if refused), statement timeout (None if not forced) and the reasons it was flagged
+    """
+    config = get_config()
+    guarded = {'query': query, 'statement_timeout': None, 'flags': []}
+    if not config.getboolean('GUARD', 'ENABLED', fallback=True):
+        return guarded
+
+    policy = (policy or config.get('GUARD', 'POLICY', fallback='warn')).lower()
+    if policy not in guard_policies:
+        raise ValueError(f"Unknown guard policy {policy}, use {', '.join(guard_policies)}")
+    flag_steps = [step.strip() for step in config.get('GUARD', 'FLAG_STEPS', fallback=','.join(default_flag_steps)).split(',')
+                  if step.strip()]
+
+    try:
+        lines = explain_query(query)
+    except Exception as e:
+        print('The query could not be explained: {}'.format(str(e).strip()))
+        guarded['query'] = None
+        return guarded
+
+    guarded['flags'] = inspect_plan(parse_plan(lines), config.getfloat('GUARD', 'COST_THRESHOLD', fallback=0), flag_steps)
+    if not guarded['flags']:
+        return guarded
+
+    print('Query flagged: {}'.format('; '.join(guarded['flags'])))
+    if policy == 'refuse':
+        print('Query refused (POLICY = refuse on the [GUARD] section).')
+        guarded['query'] = None
+    elif policy == 'limit' and is_select(query):
+        limit = config.getint('GUARD', 'LIMIT_ROWS', fallback=1000)
+        print(f'Running the query with LIMIT {limit}.')
+        guarded['query'] = limit_query(query, limit)
+    elif policy in ('limit', 'timeout'):
+        guarded['statement_timeout'] = config.getint('GUARD', 'STATEMENT_TIMEOUT', fallback=300000)
+        print(f"Running the query with a {guarded['statement_timeout']} ms statement timeout.")
+    return guarded
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def topological_order(tasks):
+    """Returns the task names ordered so every task comes after its upstream tasks
+
+    Args:
+        tasks (dictionary): Task name mapped to its definition, each with an 'upstream' list
+
+    Returns:
+        list: Task names in dependency order
+    """
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError('Cycle detected in task graph: {}'.format(' -> '.join(path + [name])))
+        state[name] = 'visiting'
+        for upstream in tasks[name].get('upstream', []):
+            if upstream in tasks:
+                visit(upstream, path + [name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in tasks:
+        visit(name, [])
+    return order
+
+def run_task_graph(tasks, run_task, max_workers=4):
+    """Runs a task graph, starting every task as soon as all of its upstream tasks succeeded
+
+    Upstream names that are not part of the graph are considered already done,
+    so a subset of the graph (e.g. only the fact & dimension tables) can be run on its own.
+
+    Args:
+        tasks (dictionary): Task name mapped to its definition, each with an 'upstream' list
+        run_task (function): Callable receiving the task name and returning a result dictionary with a 'status' key
+        max_workers (int): Maximum number of tasks running at the same time
+
+    Returns:
+        dictionary: Task name mapped to its result
+    """
+    # Validates the graph before running anything
+    topological_order(tasks)
+
+    results = {}
+    pending = set(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                upstreams = [upstream for upstream in tasks[name].get('upstream', []) if upstream in tasks]
+                if any(upstream in results and results[upstream]['status'] != 'success' for upstream in upstreams):
+                    pending.discard(name)
+                    results[name] = {'table': name, 'status': 'skipped', 'duration': None,
+                                     'error': 'Upstream task failed'}
+                elif all(results.get(upstream, {}).get('status') == 'success' for upstream in upstreams):
+                    pending.discard(name)
+                    running[executor.submit(run_task, name)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = {'table': name, 'status': 'failed', 'duration': None, 'error': str(e)}
+
+    return results
@@ -0,0 +1,94 @@
+import configparser
+import threading
+
+# Define config_file
+config_file = 'dwh.cfg'
+
+# Region of the AWS Services (the udacity-dend bucket lives in us-west-2)
+aws_region = 'us-west-2'
+
+_config = None
+_clients = {}
+_lock = threading.RLock()
+
+def get_config():
+    """Returns the configuration, reading the cfg file on first use only
+
+    Returns:
+        ConfigParser object: Configuration File shared by every module
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                config = configparser.ConfigParser()
+                config.read(config_file)
+                _config = config
+    return _config
+
+def reload_config():
+    """Discards the cached configuration so the cfg file is read again on next use"""
+    global _config
+    with _lock:
+        _config = None
+
+def update_config_file(config_file, section, key, value):
+    """Writes to an existing config file, keeping the cached configuration in sync
+
+    Args:
+        config_file (string): Configuration file the user wants to update
+        section (string): The section on the config file the user wants to write
+        key (string): The key the user wants to write
+        value (string): The value the user wants to write
+    """
+    try:
+        # Reading cfg file
+        config = configparser.ConfigParser()
+        config.read(config_file)
+
+        #Setting  Section, Key and Value to be write on the cfg file
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+
+        # Writting to cfg file
+        with open(config_file, 'w') as f:
+            config.write(f)
+    except (OSError, configparser.Error) as e:
+        print(f'ERROR: {e}')
+    else:
+        reload_config()
+
+def get_client(service):
+    """Returns a shared AWS client, building it (and importing boto3) on first use only
+
+    Args:
+        service (string): AWS service name (e.g. redshift, iam, ec2, s3)
+
+    Returns:
+        boto3 client: Client of the AWS service
+    """
+    if service not in _clients:
+        with _lock:
+            if service not in _clients:
+                import boto3
+
+                config = get_config()
+                _clients[service] = boto3.client(
+                    service,
+                    region_name=aws_region,
+                    aws_access_key_id=config.get('AWS', 'KEY') or None,
+                    aws_secret_access_key=config.get('AWS', 'SECRET') or None
+                )
+    return _clients[service]
+
+def client_error():
+    """Returns botocore's ClientError, importing botocore on first use only
+
+    Used as `except client_error() as e:`, which is only evaluated once an exception reaches the handler.
+
+    Returns:
+        class: botocore.exceptions.ClientError
+    """
+    from botocore.exceptions import ClientError
+    return ClientError
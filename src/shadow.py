@@ -0,0 +1,189 @@
+import re
+import time
+from instrumentation import instrumented_execute
+from sql_objects import (sql_tasks, table_columns, table_design, transform_tables, final_tables, build_create_table,
+                         get_load_query, run_table_tasks, get_max_workers, drop_materialized_views)
+
+# Final tables are built under these suffixes and swapped in once they are checked
+shadow_suffix = '_shadow'
+old_suffix = '_old'
+
+def shadow_name(table):
+    """Returns the name of the shadow table of a final table"""
+    return table + shadow_suffix
+
+def rename_tables(query, mapping):
+    """Rewrites the table names of SQL statements
+
+    Args:
+        query (string or list): SQL statement, or list of statements
+        mapping (dictionary): Table name mapped to the name it is replaced by
+
+    Returns:
+        string or list: SQL statement(s) reading from & writing to the replaced tables
+    """
+    if isinstance(query, list):
+        return [rename_tables(statement, mapping) for statement in query]
+    pattern = re.compile(r'\b({})\b'.format('|'.join(re.escape(table) for table in mapping)))
+    return pattern.sub(lambda match: mapping[match.group(1)], query)
+
+def get_primary_key(table):
+    """Returns the primary key column of a table (None if it has none)"""
+    for column, column_type in table_columns[table]:
+        if 'PRIMARY KEY' in column_type:
+            return column
+    return None
+
+def recreate_tables(cur, conn, tables):
+    """Drops and creates tables within a single transaction
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        tables (list): Table names, in load order
+    """
+    for table in reversed(tables):
+        instrumented_execute(cur, 'drop', table, sql_tasks[table]['drop'])
+    for table in tables:
+        instrumented_execute(cur, 'create', table, sql_tasks[table]['create'])
+    conn.commit()
+
+def create_shadow_tables(cur, conn):
+    """Creates empty shadow tables for the final tables, within a single transaction
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+    """
+    for table in final_tables:
+        cur.execute('DROP TABLE IF EXISTS {};'.format(shadow_name(table)))
+        instrumented_execute(cur, 'create', shadow_name(table),
+                             build_create_table(shadow_name(table), table_columns[table], table_design[table]))
+    conn.commit()
+
+def drop_shadow_tables(cur, conn):
+    """Drops the shadow tables left by a failed build
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+    """
+    for table in final_tables:
+        cur.execute('DROP TABLE IF EXISTS {};'.format(shadow_name(table)))
+    conn.commit()
+
+def load_shadow_tables(cur, conn, parallel=False, max_workers=None):
+    """Loads the transform tables in place and the final tables into their shadow tables
+
+    Serial loads run as a single transaction, parallel loads commit each table on its own connection.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        parallel (boolean): Whether to load independent tables at the same time
+        max_workers (int): Maximum number of concurrent statements (defaults to MAX_PARALLEL_INSERTS on the cfg file)
+
+    Returns:
+        list: Load status of each table (only failures are reported on serial loads)
+    """
+    mapping = {table: shadow_name(table) for table in final_tables}
+    tables = transform_tables + final_tables
+    tasks = {table: dict(sql_tasks[table], load=rename_tables(get_load_query(sql_tasks[table]), mapping))
+             for table in tables}
+
+    if parallel:
+        if max_workers is None:
+            max_workers = get_max_workers('MAX_PARALLEL_INSERTS', len(final_tables))
+        results = run_table_tasks(tables, max_workers, tasks)
+        return [results[table] for table in tables]
+
+    for table in tables:
+        load = tasks[table]['load']
+        try:
+            for statement in load if isinstance(load, list) else [load]:
+                instrumented_execute(cur, 'transform', table, statement)
+        except Exception as e:
+            conn.rollback()
+            return [{'table': table, 'status': 'failed', 'duration': None, 'error': str(e).strip()}]
+    conn.commit()
+    return []
+
+def check_shadow_tables(cur):
+    """Checks the shadow tables before they are swapped in: every table holds rows and a single row per key
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+
+    Returns:
+        list: Problems found (empty if the tables can be swapped in)
+    """
+    problems = []
+    for table in final_tables:
+        key = get_primary_key(table)
+        cur.execute('SELECT COUNT(1), COUNT(DISTINCT {}) FROM {};'.format(key or 1, shadow_name(table)))
+        rows, keys = cur.fetchone()
+        if rows == 0:
+            problems.append(f'{table} is empty')
+        elif key and rows != keys:
+            problems.append(f'{table} holds {rows - keys} duplicate {key} rows')
+    return problems
+
+def swap_shadow_tables(cur, conn):
+    """Swaps the shadow tables in for the final tables with ALTER TABLE ... RENAME, in a single transaction
+
+    Readers see either every old table or every new one. The old tables are dropped within the same transaction,
+    along with the materialized views reading from them (recreated once the load is done).
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+    """
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")
+    existing = set(row[0] for row in cur.fetchall())
+    try:
+        drop_materialized_views(cur)
+        for table in final_tables:
+            if table + old_suffix in existing:
+                cur.execute('DROP TABLE {};'.format(table + old_suffix))
+            if table in existing:
+                instrumented_execute(cur, 'swap', table, 'ALTER TABLE {} RENAME TO {};'.format(table, table + old_suffix))
+            instrumented_execute(cur, 'swap', table, 'ALTER TABLE {} RENAME TO {};'.format(shadow_name(table), table))
+            if table in existing:
+                cur.execute('DROP TABLE {};'.format(table + old_suffix))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def build_and_swap(cur, conn, parallel=False, max_workers=None):
+    """Builds the final tables into shadow tables, checks them and swaps them in atomically
+
+    The live tables stay readable until the swap. On failure the shadow tables are dropped and the live tables are left untouched.
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+        parallel (boolean): Whether to load independent tables at the same time
+        max_workers (int): Maximum number of concurrent statements
+
+    Returns:
+        list: Load status of each table, including a 'swap' entry
+    """
+    swap = {'table': 'swap', 'status': 'success', 'duration': None, 'error': None}
+    results = []
+    start = time.time()
+    try:
+        create_shadow_tables(cur, conn)
+        results = load_shadow_tables(cur, conn, parallel, max_workers)
+        failed = [result['table'] for result in results if result['status'] != 'success']
+        problems = [f'{table} failed to load' for table in failed] or check_shadow_tables(cur)
+        if problems:
+            raise RuntimeError('; '.join(problems))
+        swap_shadow_tables(cur, conn)
+    except Exception as e:
+        conn.rollback()
+        swap['status'] = 'failed'
+        swap['error'] = 'live tables kept: {}'.format(str(e).strip())
+        drop_shadow_tables(cur, conn)
+    swap['duration'] = round(time.time() - start, 3)
+    return results + [swap]
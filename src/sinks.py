@@ -0,0 +1,116 @@
+import csv
+import datetime
+import decimal
+import json
+
+class ConsoleSink:
+    """Prints rows to the console one page at a time
+
+    Args:
+        page_size (int): Number of rows per page
+        pause (boolean): Whether to wait for the user before printing the next page
+    """
+
+    def __init__(self, page_size=50, pause=False):
+        self.page_size = max(1, page_size)
+        self.pause = pause
+        self.rows = 0
+
+    def open(self, columns):
+        """Starts the output with the column names"""
+        print(' | '.join(columns))
+
+    def write(self, row):
+        """Writes a single row"""
+        if self.rows > 0 and self.rows % self.page_size == 0:
+            if self.pause:
+                input(f'-- {self.rows} rows, press [enter] for the next page --')
+            else:
+                print(f'-- {self.rows} rows --')
+        print(row)
+        self.rows += 1
+
+    def close(self):
+        """Finishes the output"""
+        pass
+
+class CsvSink:
+    """Writes rows to a CSV file
+
+    Args:
+        path (string): Output file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def open(self, columns):
+        """Starts the output with the column names"""
+        self.file = open(self.path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        """Writes a single row"""
+        self.writer.writerow(row)
+
+    def close(self):
+        """Finishes the output"""
+        if self.file is not None:
+            self.file.close()
+            print(f'Results written to {self.path}')
+
+def json_default(value):
+    """Serializes the values json does not handle natively (timestamps & decimals)"""
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value)
+
+class JsonLinesSink:
+    """Writes rows to a JSON-lines file, one object per row
+
+    Args:
+        path (string): Output file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.columns = []
+
+    def open(self, columns):
+        """Starts the output with the column names"""
+        self.columns = columns
+        self.file = open(self.path, 'w')
+
+    def write(self, row):
+        """Writes a single row"""
+        self.file.write(json.dumps(dict(zip(self.columns, row)), default=json_default) + '\n')
+
+    def close(self):
+        """Finishes the output"""
+        if self.file is not None:
+            self.file.close()
+            print(f'Results written to {self.path}')
+
+def get_sink(name, path='', page_size=50, pause=False):
+    """Returns a result sink by name
+
+    Args:
+        name (string): 'console', 'csv' or 'jsonl'
+        path (string): Output file path of the csv and jsonl sinks
+        page_size (int): Number of rows per page of the console sink
+        pause (boolean): Whether the console sink waits for the user between pages
+
+    Returns:
+        object: Sink with open, write and close methods
+    """
+    if name == 'csv':
+        return CsvSink(path or 'results.csv')
+    if name == 'jsonl':
+        return JsonLinesSink(path or 'results.jsonl')
+    return ConsoleSink(page_size, pause)
@@ -1,20 +1,25 @@
-import configparser
+import os
+import pickle
 import psycopg2
-from create_resources import config_file
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from settings import get_config
+from scheduler import run_task_graph, topological_order
+from sinks import get_sink
+from instrumentation import instrumented_execute
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read(config_file)
-
-def create_connection():
-    """Creates Redshift Connection
+def open_connection():
+    """Opens a new Redshift Connection
 
     Returns:
-        SQL Connection Object: Cursor and Connection objects used to execute queries
+        connection object: Connection to SQL Engine
     """
     # Read CFG File
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    config = get_config()
 
     # Variables to create connection to Redshift Cluster
     host = config.get('CLUSTER', 'HOST')
@@ -24,9 +29,230 @@ def create_connection():
     port = config.getint('CLUSTER', 'DB_PORT')
 
     # Connecting to Redshift Cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(host, db_name, db_username, db_password, port))
-    cur = conn.cursor()
-    return cur, conn
+    return psycopg2.connect("host={} dbname={} user={} password={} port={}".format(host, db_name, db_username, db_password, port))
+
+class ConnectionPool:
+    """Thread-safe pool of reusable Redshift connections
+
+    Args:
+        min_size (int): Number of connections kept open even when idle
+        max_size (int): Maximum number of connections open at the same time
+        idle_timeout (int): Seconds an idle connection above min_size is kept before being closed
+        checkout_timeout (int): Seconds to wait for a free connection before giving up (None waits forever)
+        connect (function): Callable returning a new connection
+    """
+
+    def __init__(self, min_size=1, max_size=5, idle_timeout=300, checkout_timeout=None, connect=open_connection):
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self._connect = connect
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _is_healthy(self, conn):
+        """Checks that a pooled connection is still usable"""
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        """Closes a connection and releases its slot in the pool"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close_expired(self):
+        """Closes connections idle for longer than idle_timeout, keeping at least min_size open"""
+        now = time.time()
+        while len(self._idle) > 0 and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def getconn(self):
+        """Checks out a healthy connection, opening a new one if the pool is not full
+
+        Returns:
+            connection object: Connection to SQL Engine
+        """
+        deadline = None if self.checkout_timeout is None else time.time() + self.checkout_timeout
+        while True:
+            conn = None
+            with self._condition:
+                if self._closed:
+                    raise RuntimeError('Connection pool is closed')
+                self._close_expired()
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('No Redshift connection available after {}s'.format(self.checkout_timeout))
+                    self._condition.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """Returns a connection to the pool
+
+        Args:
+            conn (connection object): Connection previously checked out with getconn
+        """
+        if self._closed or conn.closed:
+            self._discard(conn)
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.time()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, query_group=None, statement_timeout=None):
+        """Checks out a connection for the duration of a with block
+
+        Args:
+            query_group (string): Query group the statements are labelled with, routing them to its WLM queue (reset when the connection is returned)
+            statement_timeout (int): Milliseconds after which a statement is cancelled (reset when the connection is returned)
+
+        Yields:
+            tuple: Cursor and Connection objects used to execute queries
+        """
+        conn = self.getconn()
+        cur = conn.cursor()
+        try:
+            if query_group:
+                # SET lasts for the session, so it is committed before any statement can roll it back
+                cur.execute('SET query_group TO %s;', (query_group,))
+                conn.commit()
+            if statement_timeout:
+                cur.execute('SET statement_timeout TO %s;', (int(statement_timeout),))
+                conn.commit()
+            yield cur, conn
+        finally:
+            # Session settings are reset before check-in, so the next caller does not inherit them
+            try:
+                if query_group or statement_timeout:
+                    conn.rollback()
+                    if query_group:
+                        cur.execute('RESET query_group;')
+                    if statement_timeout:
+                        cur.execute('RESET statement_timeout;')
+                    conn.commit()
+                cur.close()
+            except Exception:
+                # A connection that could not be reset is closed, so the pool discards it
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.putconn(conn)
+
+    def close(self):
+        """Closes every idle connection and refuses further checkouts"""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the connection pool shared by the ETL, validation and parallel load paths
+
+    Returns:
+        ConnectionPool: Shared Redshift connection pool
+    """
+    global pool
+    with pool_lock:
+        if pool is None or pool._closed:
+            config = get_config()
+            pool = ConnectionPool(
+                min_size=config.getint('POOL', 'MIN_SIZE', fallback=1),
+                max_size=config.getint('POOL', 'MAX_SIZE', fallback=5),
+                idle_timeout=config.getint('POOL', 'IDLE_TIMEOUT', fallback=300),
+                checkout_timeout=config.getint('POOL', 'CHECKOUT_TIMEOUT', fallback=None)
+            )
+        return pool
+
+def get_max_workers(option, fallback):
+    """Returns the number of concurrent statements set on the [ETL] section, capped to the free pooled connections
+
+    The ETL keeps a pooled connection checked out while the parallel statements run, so at most MAX_SIZE - 1
+    connections are left for them.
+
+    Args:
+        option (string): Option of the [ETL] section (e.g. MAX_PARALLEL_INSERTS)
+        fallback (int): Number of concurrent statements when the option is not set
+
+    Returns:
+        int: Maximum number of concurrent statements
+    """
+    config = get_config()
+    max_size = config.getint('POOL', 'MAX_SIZE', fallback=5)
+    return max(1, min(config.getint('ETL', option, fallback=fallback), max_size - 1))
+
+def get_query_group(workload):
+    """Returns the query group of a workload
+
+    Args:
+        workload (string): 'etl' or 'interactive'
+
+    Returns:
+        string: Query group on the cfg file (empty if none is set)
+    """
+    return get_config().get('WLM', '{}_QUERY_GROUP'.format(workload.upper()), fallback='')
+
+def close_pool():
+    """Closes the shared connection pool, if any"""
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.close()
+            pool = None
 
 def drop_tables(cur, conn):
     """Drop Table on Redshift
@@ -35,9 +261,15 @@ def drop_tables(cur, conn):
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
     """
-    for query in drop_table_queries:
+    try:
+        drop_materialized_views(cur)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(e)
+    for table in reversed(table_order):
         try:
-            cur.execute(query)
+            instrumented_execute(cur, 'drop', table, sql_tasks[table]['drop'])
             conn.commit()
         except Exception as e:
             print(e)
@@ -49,26 +281,92 @@ def create_tables(cur, conn):
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
     """
-    for query in create_table_queries:
+    for table in table_order:
         try:
-            cur.execute(query)
+            instrumented_execute(cur, 'create', table, sql_tasks[table]['create'])
             conn.commit()
         except Exception as e:
             print(e)
 
-def load_staging_tables(cur, conn):
-    """Load data into staging tables on Redshift
+def get_table_name(query):
+    """Returns the target table of a COPY or INSERT statement
 
     Args:
-        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
-        conn (connection object): Connection to SQL Engine
+        query (string): SQL Query
+
+    Returns:
+        string: Table name
     """
-    for query in copy_table_queries:
-        try:
-            cur.execute(query)
+    match = re.search(r'(?:COPY|INSERT INTO|DELETE FROM)\s+(\w+)', query, re.IGNORECASE)
+    return match.group(1) if match else None
+
+def run_statement(query, name=None, phase='transform'):
+    """Runs SQL statements over a connection checked out from the shared pool
+
+    Args:
+        query (string or list): SQL statement, or list of statements committed as a single transaction
+        name (string): Name reported in the result (defaults to the target table of the statement)
+        phase (string): Pipeline phase the statements are recorded under
+
+    Returns:
+        dictionary: Statement status, duration and error message (if any)
+    """
+    statements = query if isinstance(query, list) else [query]
+    result = {'table': name or get_table_name(statements[0]), 'status': 'success', 'duration': None, 'error': None}
+    start = time.time()
+    try:
+        with get_pool().connection(get_query_group('etl')) as (cur, conn):
+            for statement in statements:
+                instrumented_execute(cur, phase, result['table'], statement)
             conn.commit()
-        except Exception as e:
-            print(e)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e).strip()
+    result['duration'] = round(time.time() - start, 3)
+    return result
+
+def get_load_query(task):
+    """Returns the load statement(s) of a task, building them first when they are deferred
+
+    Args:
+        task (dictionary): Task of the task graph
+
+    Returns:
+        string or list: SQL statement, or list of statements
+    """
+    return task['load']() if callable(task['load']) else task['load']
+
+def run_table_tasks(tables, max_workers, tasks=None, phase='transform'):
+    """Loads a set of tables through the task graph, running independent tables at the same time
+
+    Args:
+        tables (list): Table names (keys of the task graph) to load
+        max_workers (int): Maximum number of concurrent statements
+        tasks (dictionary): Task graph to run (defaults to sql_tasks)
+        phase (string): Pipeline phase the statements are recorded under
+
+    Returns:
+        dictionary: Table name mapped to its load status
+    """
+    tasks = sql_tasks if tasks is None else tasks
+    selected = {table: tasks[table] for table in tables}
+    return run_task_graph(selected, lambda table: run_statement(get_load_query(tasks[table]), table, phase), max_workers)
+
+def insert_tables_parallel(max_workers=None):
+    """Load data into transform, fact & dimension tables on Redshift following the task graph
+
+    Args:
+        max_workers (int): Maximum number of concurrent INSERT statements (defaults to MAX_PARALLEL_INSERTS on the cfg file)
+
+    Returns:
+        list: INSERT status for each transform, fact & dimension table
+    """
+    if max_workers is None:
+        max_workers = get_max_workers('MAX_PARALLEL_INSERTS', len(final_tables))
+
+    tables = transform_tables + final_tables
+    results = run_table_tasks(tables, max_workers)
+    return [results[table] for table in tables]
 
 def insert_tables(cur, conn):
     """Load data into dimension tables on Redshift
@@ -76,40 +374,367 @@ def insert_tables(cur, conn):
     Args:
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
+
+    Returns:
+        list: INSERT status for each transform, fact & dimension table
     """
-    for query in insert_table_queries:
+    results = []
+    for table in transform_tables + final_tables:
+        load = sql_tasks[table]['load']
+        result = {'table': table, 'status': 'success', 'duration': None, 'error': None}
+        start = time.time()
         try:
-            cur.execute(query)
+            # Statement lists (e.g. dimension upserts) are committed as a single transaction
+            for statement in load if isinstance(load, list) else [load]:
+                instrumented_execute(cur, 'transform', table, statement)
             conn.commit()
         except Exception as e:
-            print(e)
+            conn.rollback()
+            result['status'] = 'failed'
+            result['error'] = str(e).strip()
+        result['duration'] = round(time.time() - start, 3)
+        results.append(result)
+    return results
 
-def execute_query(cur, conn, query):
-    """Execute SQL query on Redshift
+def fetch_query(cur, conn, query):
+    """Execute SQL query on Redshift and return its rows
 
     Args:
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
         query (string): SQL Query
+
+    Returns:
+        list: Rows returned by the query
     """
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+def stream_query(query, sink, itersize=None, max_rows=None, max_bytes=None, statement_timeout=None):
+    """Execute SQL query on Redshift, streaming its rows to a sink through a server-side cursor
+
+    Only itersize rows are held in memory at a time, whatever the size of the result.
+
+    Args:
+        query (string): SQL Query
+        sink (object): Sink with open, write and close methods (see sinks.py)
+        itersize (int): Rows fetched per round trip (defaults to ITERSIZE on the cfg file)
+        max_rows (int): Stop after this many rows (defaults to MAX_ROWS on the cfg file, 0 means no limit)
+        max_bytes (int): Stop after this many bytes of row data (defaults to MAX_BYTES on the cfg file, 0 means no limit)
+        statement_timeout (int): Milliseconds after which the query is cancelled (None keeps the cluster setting)
+
+    Returns:
+        dictionary: Number of rows and bytes streamed and whether a limit truncated the result
+    """
+    config = get_config()
+    itersize = itersize or config.getint('QUERY', 'ITERSIZE', fallback=2000)
+    max_rows = config.getint('QUERY', 'MAX_ROWS', fallback=0) if max_rows is None else max_rows
+    max_bytes = config.getint('QUERY', 'MAX_BYTES', fallback=0) if max_bytes is None else max_bytes
+
+    stats = {'rows': 0, 'bytes': 0, 'truncated': False}
+    with get_pool().connection(get_query_group('interactive'), statement_timeout) as (_, conn):
+        cur = conn.cursor(name='stream_{}'.format(threading.get_ident()))
+        cur.itersize = itersize
+        try:
+            cur.execute(query)
+            opened = False
+            for row in cur:
+                if not opened:
+                    sink.open([column[0] for column in cur.description])
+                    opened = True
+                row_bytes = sum(len(str(value).encode('utf-8')) for value in row)
+                if (max_rows and stats['rows'] >= max_rows) or (max_bytes and stats['bytes'] + row_bytes > max_bytes):
+                    stats['truncated'] = True
+                    break
+                sink.write(row)
+                stats['rows'] += 1
+                stats['bytes'] += row_bytes
+            if not opened:
+                sink.open([column[0] for column in cur.description or []])
+        finally:
+            sink.close()
+            cur.close()
+    return stats
+
+def get_load_generation():
+    """Returns the load generation, bumped by the ETL after each successful transform
+
+    Returns:
+        int: Load generation
+    """
+    return get_config().getint('ETL', 'LOAD_GENERATION', fallback=0)
+
+def normalize_query(query):
+    """Normalizes a SQL query so formatting differences share a cache entry
+
+    Args:
+        query (string): SQL Query
+
+    Returns:
+        string: Query with collapsed whitespace and no trailing semicolon
+    """
+    return ' '.join(query.split()).rstrip(';').strip()
+
+class ResultCache:
+    """Size-bounded LRU cache of query results, keyed by normalized SQL and load generation
+
+    Args:
+        max_entries (int): Maximum number of results kept, least recently used are evicted first
+        path (string): File the cache is persisted to (empty keeps it in memory only)
+    """
+
+    def __init__(self, max_entries=128, path=''):
+        self.max_entries = max(1, max_entries)
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self._entries = pickle.load(f)
+            except Exception as e:
+                print(f'Ignoring unreadable query cache {self.path}: {e}')
+
+    def get(self, query, generation):
+        """Returns the cached rows of a query for a load generation, or None"""
+        key = (normalize_query(query), generation)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, query, generation, rows):
+        """Caches the rows of a query for a load generation, dropping results of older generations"""
+        key = (normalize_query(query), generation)
+        with self._lock:
+            for stale in [entry for entry in self._entries if entry[1] != generation]:
+                del self._entries[stale]
+            self._entries[key] = rows
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def _save(self):
+        """Persists the cache to disk, if a path was given"""
+        if not self.path:
+            return
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(self._entries, f)
+        os.replace(self.path + '.tmp', self.path)
+
+result_cache = None
+
+def get_result_cache():
+    """Returns the query result cache shared by the validation queries
+
+    Returns:
+        ResultCache: Shared result cache (None if disabled on the cfg file)
+    """
+    config = get_config()
+    global result_cache
+    if not config.getboolean('CACHE', 'ENABLED', fallback=False):
+        return None
+    if result_cache is None:
+        result_cache = ResultCache(max_entries=config.getint('CACHE', 'MAX_ENTRIES', fallback=128),
+                                   path=config.get('CACHE', 'PATH', fallback=''))
+    return result_cache
+
+def execute_cached_query(query, use_cache=True, statement_timeout=None):
+    """Execute SQL query on Redshift, answering from the result cache when the load generation did not change
+
+    A cached answer is printed without checking out a connection. Queries that are not cacheable are
+    streamed to the sink set on the cfg file instead of being fetched at once.
+
+    Args:
+        query (string): SQL Query
+        use_cache (boolean): Whether the query can be answered from (and stored in) the cache
+        statement_timeout (int): Milliseconds after which the query is cancelled (None keeps the cluster setting)
+    """
+    config = get_config()
+    if not use_cache:
+        try:
+            stats = stream_query(query, get_sink(config.get('QUERY', 'SINK', fallback='console'),
+                                                 config.get('QUERY', 'OUTPUT_PATH', fallback=''),
+                                                 config.getint('QUERY', 'PAGE_SIZE', fallback=50),
+                                                 config.getboolean('QUERY', 'PAUSE', fallback=False)),
+                                 statement_timeout=statement_timeout)
+            print(f"{stats['rows']} rows{' (truncated by the row/byte limit)' if stats['truncated'] else ''}")
+        except Exception as e:
+            print(e)
+        return
+
+    cache = get_result_cache()
+    generation = get_load_generation()
+    if cache is not None:
+        rows = cache.get(query, generation)
+        if rows is not None:
+            print('(cached result)')
+            for row in rows:
+                print(row)
+            return
+
     try:
-        cur.execute(query)
-        rows = cur.fetchall()
-        for row in rows:
-            print(row)
-        conn.commit()
+        with get_pool().connection(get_query_group('interactive'), statement_timeout) as (cur, conn):
+            rows = fetch_query(cur, conn, query)
     except Exception as e:
         print(e)
+        return
+
+    if cache is not None:
+        cache.put(query, generation, rows)
+    for row in rows:
+        print(row)
+
+# Queue wait of the queries run by each query group (stl_query.label) in the user WLM queues
+queue_wait_summary = ("""
+    SELECT TRIM(q.label) AS query_group,
+           w.service_class,
+           COUNT(1) AS queries,
+           ROUND(AVG(w.total_queue_time) / 1000000.0, 3) AS avg_queue_seconds,
+           ROUND(MAX(w.total_queue_time) / 1000000.0, 3) AS max_queue_seconds,
+           ROUND(AVG(w.total_exec_time) / 1000000.0, 3) AS avg_exec_seconds
+    FROM stl_wlm_query w
+    Inner Join stl_query q ON w.query = q.query
+    WHERE w.service_class >= 6
+      AND w.queue_start_time >= DATEADD(hour, -{}, GETDATE())
+    Group By TRIM(q.label), w.service_class
+    Order By query_group, w.service_class;
+""")
+
+def queue_wait_report(cur, hours=24):
+    """Reports the time queries spent waiting in their WLM queue, per query group
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        hours (int): How far back to look
+
+    Returns:
+        list: Dictionaries with the query group, service class, number of queries and average & max queue wait of each queue
+    """
+    cur.execute(queue_wait_summary.format(int(hours)))
+    return [{'query_group': query_group, 'service_class': service_class, 'queries': queries,
+             'avg_queue_seconds': float(avg_queue), 'max_queue_seconds': float(max_queue), 'avg_exec_seconds': float(avg_exec)}
+            for query_group, service_class, queries, avg_queue, max_queue, avg_exec in cur.fetchall()]
 
-def get_query(question_number):
+def check_data_distribution(cur, question_numbers=(1, 2, 3)):
+    """Runs EXPLAIN on the validation queries and reports the steps that broadcast or redistribute data
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        question_numbers (tuple): Question numbers whose query is explained
+
+    Returns:
+        dictionary: Question number mapped to the DS_BCAST / DS_DIST steps found on its plan
+    """
+    report = {}
+    for question_number in question_numbers:
+        cur.execute('EXPLAIN ' + get_query(question_number, use_views=False))
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        report[question_number] = sorted(set(step for step in re.findall(r'DS_(?:BCAST|DIST)_\w+', plan)
+                                             if not step.endswith('_NONE')))
+    return report
+
+# MATERIALIZED VIEWS
+# Questions 1 to 3 are pre-aggregated by materialized views, refreshed (incrementally when Redshift can) after each load
+
+question_views = {
+    1: {'name': 'mv_artist_plays',
+        'create': """
+    CREATE MATERIALIZED VIEW mv_artist_plays AUTO REFRESH NO AS
+    SELECT a.name AS artist_name, COUNT(*) AS plays
+    FROM songplays sp
+    Inner Join artists a ON sp.artist_id = a.artist_id
+    Group By a.name;
+""",
+        'query': "select artist_name, plays from mv_artist_plays Order By plays Desc Limit 10"},
+    2: {'name': 'mv_song_plays',
+        'create': """
+    CREATE MATERIALIZED VIEW mv_song_plays AUTO REFRESH NO AS
+    SELECT s.title AS song_title, COUNT(*) AS plays
+    FROM songplays sp
+    Inner Join songs s ON sp.song_id = s.song_id
+    Group By s.title;
+""",
+        'query': "select song_title, plays from mv_song_plays Order By plays Desc Limit 10"},
+    3: {'name': 'mv_hour_plays',
+        'create': """
+    CREATE MATERIALIZED VIEW mv_hour_plays AUTO REFRESH NO AS
+    SELECT t.hour, COUNT(*) AS plays
+    FROM songplays sp
+    Inner Join time t ON sp.start_time = t.start_time
+    Group By t.hour;
+""",
+        'query': "select hour, plays from mv_hour_plays Order By hour Desc"}
+}
+
+def drop_materialized_views(cur):
+    """Drops the materialized views of the validation questions, so the tables they read from can be dropped or swapped
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+    """
+    for view in question_views.values():
+        instrumented_execute(cur, 'drop', view['name'], 'DROP MATERIALIZED VIEW IF EXISTS {};'.format(view['name']))
+
+def views_are_fresh():
+    """Checks whether the materialized views were refreshed after the latest load
+
+    Returns:
+        boolean: Whether VIEWS_GENERATION matches LOAD_GENERATION on the cfg file
+    """
+    config = get_config()
+    if not config.getboolean('ETL', 'MATERIALIZED_VIEWS', fallback=False):
+        return False
+    return config.getint('ETL', 'VIEWS_GENERATION', fallback=-1) == get_load_generation()
+
+def refresh_materialized_views(cur, conn):
+    """Creates the missing materialized views of the validation questions and refreshes the existing ones
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        conn (connection object): Connection to SQL Engine
+
+    Returns:
+        boolean: Whether every view is up to date
+    """
+    cur.execute("SELECT TRIM(name) FROM stv_mv_info WHERE TRIM(schema) = 'public';")
+    existing = set(row[0] for row in cur.fetchall())
+    conn.commit()
+
+    success = True
+    for view in question_views.values():
+        try:
+            if view['name'] in existing:
+                instrumented_execute(cur, 'refresh', view['name'], 'REFRESH MATERIALIZED VIEW {};'.format(view['name']))
+            else:
+                instrumented_execute(cur, 'create', view['name'], view['create'])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(e)
+            success = False
+    return success
+
+def get_query(question_number, use_views=True):
     """Function to return a SQL query based on a question number
 
+    Questions 1 to 3 read their materialized view when it was refreshed after the latest load,
+    and fall back to the query over the base tables otherwise.
+
     Args:
         question_number (int): Question number the user wants to answer
+        use_views (boolean): Whether questions 1 to 3 may be answered from their materialized view
 
     Returns:
         string: SQL Query
     """
+    if use_views and question_number in question_views and views_are_fresh():
+        return question_views[question_number]['query']
+
     query = {
               1: "select a.name as artist_name, Count(1) As Plays from songplays as sp inner join artists as a on sp.artist_id = a.artist_id Group By Name Order By Plays Desc Limit 10"
              ,2: "select s.title as song_title, Count(1) As Plays from songplays as sp inner join songs as s on sp.song_id = s.song_id Group By title Order By Plays Desc Limit 10"
@@ -130,167 +755,410 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+staging_plays_table_drop = "DROP TABLE IF EXISTS staging_plays;"
+staging_song_keys_table_drop = "DROP TABLE IF EXISTS staging_song_keys;"
 
 # CREATE TABLES
 
-staging_events_table_create = ("""
-    CREATE TABLE staging_events (
-        artist VARCHAR,
-        auth VARCHAR,
-        first_name VARCHAR,
-        gender CHAR,
-        session_item INT,
-        last_name VARCHAR,
-        length FLOAT,
-        level VARCHAR,
-        location VARCHAR,
-        method VARCHAR,
-        page VARCHAR,
-        registration BIGINT,
-        session_id INT,
-        song VARCHAR ,
-        status INT,
-        ts BIGINT,
-        user_agent VARCHAR,
-        user_id INT
-    );
-""")
+table_columns = {
+    'staging_events': [
+        ('artist', 'VARCHAR'), ('auth', 'VARCHAR'), ('first_name', 'VARCHAR'), ('gender', 'CHAR'),
+        ('session_item', 'INT'), ('last_name', 'VARCHAR'), ('length', 'FLOAT'), ('level', 'VARCHAR'),
+        ('location', 'VARCHAR'), ('method', 'VARCHAR'), ('page', 'VARCHAR'), ('registration', 'BIGINT'),
+        ('session_id', 'INT'), ('song', 'VARCHAR'), ('status', 'INT'), ('ts', 'BIGINT'),
+        ('user_agent', 'VARCHAR'), ('user_id', 'INT')
+    ],
+    'staging_songs': [
+        ('artist_id', 'VARCHAR'), ('artist_location', 'VARCHAR'), ('artist_latitude', 'FLOAT'),
+        ('artist_longitude', 'FLOAT'), ('artist_name', 'VARCHAR'), ('duration', 'FLOAT'), ('num_songs', 'INT'),
+        ('song_id', 'VARCHAR'), ('title', 'VARCHAR'), ('year', 'INT')
+    ],
+    'songplays': [
+        ('songplay_id', 'INT IDENTITY(0, 1) NOT NULL PRIMARY KEY'), ('start_time', 'TIMESTAMP NOT NULL'),
+        ('user_id', 'VARCHAR NOT NULL'), ('level', 'VARCHAR NOT NULL'), ('song_id', 'VARCHAR NOT NULL'),
+        ('artist_id', 'VARCHAR NOT NULL'), ('session_id', 'INT'), ('location', 'VARCHAR'), ('user_agent', 'VARCHAR')
+    ],
+    'users': [
+        ('user_id', 'VARCHAR NOT NULL PRIMARY KEY'), ('first_name', 'VARCHAR NOT NULL'),
+        ('last_name', 'VARCHAR NOT NULL'), ('gender', 'CHAR'), ('level', 'VARCHAR NOT NULL')
+    ],
+    'songs': [
+        ('song_id', 'VARCHAR NOT NULL PRIMARY KEY'), ('title', 'VARCHAR NOT NULL'), ('artist_id', 'VARCHAR NOT NULL'),
+        ('year', 'INT'), ('duration', 'INT')
+    ],
+    'artists': [
+        ('artist_id', 'VARCHAR NOT NULL PRIMARY KEY'), ('name', 'VARCHAR NOT NULL'), ('location', 'VARCHAR'),
+        ('latitude', 'FLOAT'), ('longitude', 'FLOAT')
+    ],
+    'staging_plays': [
+        ('play_key', 'CHAR(32) NOT NULL'), ('ts', 'BIGINT'), ('user_id', 'INT'), ('level', 'VARCHAR'),
+        ('song', 'VARCHAR'), ('artist', 'VARCHAR'), ('session_id', 'INT'), ('location', 'VARCHAR'),
+        ('user_agent', 'VARCHAR')
+    ],
+    'staging_song_keys': [
+        ('song_key', 'CHAR(32) NOT NULL'), ('song_id', 'VARCHAR'), ('artist_id', 'VARCHAR')
+    ],
+    'time': [
+        ('start_time', 'TIMESTAMP NOT NULL PRIMARY KEY'), ('hour', 'INT NOT NULL'), ('day', 'INT NOT NULL'),
+        ('week', 'INT NOT NULL'), ('month', 'INT NOT NULL'), ('year', 'INT NOT NULL'), ('weekday', 'INT NOT NULL')
+    ]
+}
 
-staging_songs_table_create = ("""
-    CREATE TABLE staging_songs (
-        artist_id VARCHAR,
-        artist_location VARCHAR,
-        artist_latitude FLOAT,
-        artist_longitude FLOAT,
-        artist_name VARCHAR,
-        duration FLOAT,
-        num_songs INT,
-        song_id VARCHAR,
-        title VARCHAR,
-        year INT
-    );
-""")
+# PHYSICAL DESIGN
+# songplays & songs share the song_id distribution key so their join is collocated, the small dimensions
+# are copied to every node (ALL) and songplays is sorted by start_time for the time-based queries.
+# Columns are encoded with AZ64 (integer & timestamp types) or ZSTD (everything else) unless overridden,
+# except for the leading sort key column which is left RAW. The transform tables share the match key
+# distribution so the songplays join is collocated.
 
-songplay_table_create = ("""
-    CREATE TABLE songplays (
-        songplay_id INT IDENTITY(0, 1) NOT NULL PRIMARY KEY,
-        start_time TIMESTAMP NOT NULL,
-        user_id VARCHAR NOT NULL,
-        level VARCHAR NOT NULL,
-        song_id VARCHAR NOT NULL,
-        artist_id VARCHAR NOT NULL,
-        session_id INT,
-        location VARCHAR,
-        user_agent VARCHAR
-    );
-""")
+table_design = {
+    'staging_events': {'diststyle': 'EVEN'},
+    'staging_songs': {'diststyle': 'EVEN'},
+    'staging_plays': {'diststyle': 'KEY', 'distkey': 'play_key'},
+    'staging_song_keys': {'diststyle': 'KEY', 'distkey': 'song_key'},
+    'songplays': {'diststyle': 'KEY', 'distkey': 'song_id', 'sortkey': ['start_time']},
+    'users': {'diststyle': 'ALL', 'sortkey': ['user_id']},
+    'songs': {'diststyle': 'KEY', 'distkey': 'song_id', 'sortkey': ['song_id']},
+    'artists': {'diststyle': 'ALL', 'sortkey': ['artist_id']},
+    'time': {'diststyle': 'ALL', 'sortkey': ['start_time']}
+}
 
-user_table_create = ("""
-    CREATE TABLE users (
-        user_id VARCHAR NOT NULL PRIMARY KEY,
-        first_name VARCHAR NOT NULL,
-        last_name VARCHAR NOT NULL,
-        gender CHAR,
-        level VARCHAR NOT NULL
-    );
-""")
+az64_types = ('SMALLINT', 'INT', 'INTEGER', 'BIGINT', 'DECIMAL', 'NUMERIC', 'DATE', 'TIMESTAMP', 'TIMESTAMPTZ')
 
-song_table_create = ("""
-    CREATE TABLE songs (
-        song_id VARCHAR NOT NULL PRIMARY KEY,
-        title VARCHAR NOT NULL,
-        artist_id VARCHAR NOT NULL,
-        year INT,
-        duration INT
-    );
-""")
+def column_encoding(column, column_type, design):
+    """Returns the compression encoding of a column
 
-artist_table_create = ("""
-    CREATE TABLE artists (
-        artist_id VARCHAR NOT NULL PRIMARY KEY,
-        name VARCHAR NOT NULL,
-        location VARCHAR,
-        latitude FLOAT,
-        longitude FLOAT
-    );
-""")
+    Args:
+        column (string): Column name
+        column_type (string): Column definition (e.g. 'VARCHAR NOT NULL')
+        design (dictionary): Physical design of the table
 
-time_table_create = ("""
-    CREATE TABLE time (
-        start_time TIMESTAMP NOT NULL PRIMARY KEY,
-        hour INT NOT NULL,
-        day INT NOT NULL,
-        week INT NOT NULL,
-        month INT NOT NULL,
-        year INT NOT NULL,
-        weekday INT NOT NULL
-    );
-""")
+    Returns:
+        string: Encoding name
+    """
+    if column in design.get('encode', {}):
+        return design['encode'][column]
+    if design.get('sortkey') and design['sortkey'][0] == column:
+        return 'RAW'
+    return 'AZ64' if column_type.split()[0].split('(')[0].upper() in az64_types else 'ZSTD'
+
+def build_create_table(table, columns, design=None):
+    """Builds the CREATE TABLE statement of a table, following its physical design
+
+    Args:
+        table (string): Table name
+        columns (list): Column name and definition pairs
+        design (dictionary): DISTSTYLE, DISTKEY, SORTKEY and per-column ENCODE overrides of the table
+
+    Returns:
+        string: CREATE TABLE statement
+    """
+    design = design or {}
+    definitions = []
+    for column, column_type in columns:
+        # ENCODE goes after the data type (and IDENTITY) but before the column constraints
+        parts = re.split(r'\s+(?=NOT NULL|PRIMARY KEY)', column_type, maxsplit=1)
+        definition = '        {} {} ENCODE {}'.format(column, parts[0], column_encoding(column, column_type, design))
+        definitions.append(definition + (' ' + parts[1] if len(parts) > 1 else ''))
+    definitions = ',\n'.join(definitions)
+
+    attributes = ''
+    if design.get('diststyle'):
+        attributes += '\n    DISTSTYLE {}'.format(design['diststyle'])
+    if design.get('distkey'):
+        attributes += '\n    DISTKEY ({})'.format(design['distkey'])
+    if design.get('sortkey'):
+        attributes += '\n    SORTKEY ({})'.format(', '.join(design['sortkey']))
+
+    return '\n    CREATE TABLE {} (\n{}\n    ){};\n'.format(table, definitions, attributes)
+
+staging_events_table_create = build_create_table('staging_events', table_columns['staging_events'], table_design['staging_events'])
+staging_songs_table_create = build_create_table('staging_songs', table_columns['staging_songs'], table_design['staging_songs'])
+songplay_table_create = build_create_table('songplays', table_columns['songplays'], table_design['songplays'])
+user_table_create = build_create_table('users', table_columns['users'], table_design['users'])
+song_table_create = build_create_table('songs', table_columns['songs'], table_design['songs'])
+artist_table_create = build_create_table('artists', table_columns['artists'], table_design['artists'])
+time_table_create = build_create_table('time', table_columns['time'], table_design['time'])
+staging_plays_table_create = build_create_table('staging_plays', table_columns['staging_plays'], table_design['staging_plays'])
+staging_song_keys_table_create = build_create_table('staging_song_keys', table_columns['staging_song_keys'], table_design['staging_song_keys'])
 
 # STAGING TABLES
 
-staging_events_copy = ("""
+staging_events_copy_template = ("""
     COPY staging_events
-    FROM '{}'
-    IAM_ROLE '{}'
-    JSON '{}';
-""").format(config.get('S3', 'LOG_DATA'), config.get('SECURITY', 'ROLE_ARN'), config.get('S3', 'LOG_JSONPATH'))
+    FROM '{source}'
+    IAM_ROLE '{role_arn}'
+    JSON '{jsonpath}'{options};
+""")
 
-staging_songs_copy = ("""
+staging_songs_copy_template = ("""
     COPY staging_songs
-    FROM '{}'
-    IAM_ROLE '{}'
-    FORMAT AS JSON 'auto';
-""").format(config.get('S3', 'SONG_DATA'), config.get('SECURITY', 'ROLE_ARN'))
+    FROM '{source}'
+    IAM_ROLE '{role_arn}'
+    FORMAT AS JSON 'auto'{options};
+""")
 
-# FINAL TABLES
+# Files converted locally by converter.py are loaded with a generic template, in CSV (gzip) or Parquet format
+staging_converted_copy_template = ("""
+    COPY {table}
+    FROM '{source}'
+    IAM_ROLE '{role_arn}'
+    {format}{options};
+""")
 
-songplay_table_insert = ("""
-    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 Second ',
+# COPY format clause of each converted format (the converter writes empty strings as empty fields)
+staging_formats = {
+    'csv': "FORMAT AS CSV GZIP IGNOREHEADER 1 EMPTYASNULL",
+    'parquet': "FORMAT AS PARQUET"
+}
+
+# Suffix of the staged files of each format
+staging_suffixes = {'json': '.json', 'csv': '.csv.gz', 'parquet': '.parquet'}
+
+# S3 config key holding the source prefix of each staging table
+staging_sources = {'staging_events': 'LOG_DATA', 'staging_songs': 'SONG_DATA'}
+
+def get_staging_format():
+    """Returns the format the staging tables are loaded from (json, csv or parquet)
+
+    Returns:
+        string: STAGING_FORMAT on the cfg file
+    """
+    staging_format = get_config().get('S3', 'STAGING_FORMAT', fallback='json').lower()
+    if staging_format not in staging_suffixes:
+        raise ValueError(f'Unknown STAGING_FORMAT {staging_format}, use one of {", ".join(staging_suffixes)}')
+    return staging_format
+
+def get_staging_source(table, staging_format=None):
+    """Returns the S3 prefix a staging table is loaded from
+
+    Raw JSON is read from the table prefix on the cfg file, converted files from STAGED_DATA/<table>/.
+
+    Args:
+        table (string): Staging table name
+        staging_format (string): json, csv or parquet (defaults to STAGING_FORMAT on the cfg file)
+
+    Returns:
+        string: S3 prefix
+    """
+    config = get_config()
+    if (staging_format or get_staging_format()) == 'json':
+        return config.get('S3', staging_sources[table])
+    return '{}/{}/'.format(config.get('S3', 'STAGED_DATA').rstrip('/'), table)
+
+def staging_copy(table, source=None, manifest=False):
+    """Returns the COPY statement loading a staging table
+
+    Args:
+        table (string): Staging table name (staging_events or staging_songs)
+        source (string): S3 prefix, key or manifest to load from (defaults to the table prefix of the staging format)
+        manifest (boolean): Whether source is a manifest file listing the keys to load
+
+    Returns:
+        string: COPY statement
+    """
+    config = get_config()
+    staging_format = get_staging_format()
+    # Staging tables are dropped or truncated on every load, so COPY skips the statistics & compression analysis
+    options = '\n    STATUPDATE OFF\n    COMPUPDATE OFF' + ('\n    MANIFEST' if manifest else '')
+    # Up to MAX_ERRORS bad rows are skipped (and logged to stl_load_errors) instead of failing the whole COPY,
+    # columnar files do not support MAXERROR
+    max_errors = config.getint('LOAD', 'MAX_ERRORS', fallback=0)
+    if max_errors > 0 and staging_format != 'parquet':
+        options += '\n    MAXERROR {}'.format(min(max_errors, 100000))
+    if staging_format != 'json':
+        return staging_converted_copy_template.format(
+            table=table,
+            source=source or get_staging_source(table),
+            role_arn=config.get('SECURITY', 'ROLE_ARN'),
+            format=staging_formats[staging_format],
+            options=options
+        )
+    template = {'staging_events': staging_events_copy_template, 'staging_songs': staging_songs_copy_template}[table]
+    return template.format(
+        source=source or get_staging_source(table),
+        role_arn=config.get('SECURITY', 'ROLE_ARN'),
+        jsonpath=config.get('S3', 'LOG_JSONPATH'),
+        options=options
+    )
+
+# COPY statements are built when they run, so they pick up the ROLE_ARN written once the resources are created
+staging_events_copy = partial(staging_copy, 'staging_events')
+staging_songs_copy = partial(staging_copy, 'staging_songs')
+
+# TRANSFORM TABLES
+# Song plays are matched to songs on a compact hash of the normalized (title, artist, duration) tuple,
+# computed once per staging row instead of comparing wide VARCHARs on every event.
+
+def match_key(title, artist, duration):
+    """Returns the SQL expression of the key used to match song plays to songs
+
+    Args:
+        title (string): Song title column
+        artist (string): Artist name column
+        duration (string): Song duration column
+
+    Returns:
+        string: SQL expression
+    """
+    return ("MD5(LOWER(TRIM({})) || '|' || LOWER(TRIM({})) || '|' || CAST(CAST({} AS DECIMAL(10, 2)) AS VARCHAR))"
+            .format(title, artist, duration))
+
+staging_plays_insert = ("""
+    INSERT INTO staging_plays (play_key, ts, user_id, level, song, artist, session_id, location, user_agent)
+    SELECT {},
+           ts,
            user_id,
            level,
-           song_id,
-           artist_id,
+           song,
+           artist,
            session_id,
            location,
            user_agent
-    FROM staging_events e
-    Inner Join staging_songs s ON e.song = s.title AND e.artist = s.artist_name
-""")
-
-user_table_insert = ("""
-    INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT (user_id),
-           first_name,
-           last_name,
-           gender,
-           level
     FROM staging_events
-    WHERE user_id IS NOT NULL;
+    WHERE page = 'NextSong'
+      AND song IS NOT NULL
+      AND artist IS NOT NULL
+      AND length IS NOT NULL;
+""").format(match_key('song', 'artist', 'length'))
+
+staging_song_keys_insert = ("""
+    INSERT INTO staging_song_keys (song_key, song_id, artist_id)
+    SELECT {},
+           song_id,
+           artist_id
+    FROM staging_songs
+    WHERE title IS NOT NULL
+      AND artist_name IS NOT NULL
+      AND duration IS NOT NULL;
+""").format(match_key('title', 'artist_name', 'duration'))
+
+unmatched_plays_summary = ("""
+    SELECT COUNT(1) AS plays,
+           SUM(CASE WHEN k.song_key IS NULL THEN 1 ELSE 0 END) AS unmatched
+    FROM staging_plays p
+    Left Join (SELECT DISTINCT song_key FROM staging_song_keys) k ON p.play_key = k.song_key;
 """)
 
-song_table_insert = ("""
-    INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT DISTINCT(song_id),
-           title,
-           artist_id,
-           year,
-           duration
-    FROM staging_songs;
+unmatched_plays_top = ("""
+    SELECT p.song, p.artist, COUNT(1) AS plays
+    FROM staging_plays p
+    Left Join (SELECT DISTINCT song_key FROM staging_song_keys) k ON p.play_key = k.song_key
+    WHERE k.song_key IS NULL
+    Group By p.song, p.artist
+    Order By plays Desc
+    Limit {};
 """)
 
-artist_table_insert = ("""
-    INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT DISTINCT (artist_id),
-           artist_name,
-           artist_location,
-           artist_latitude,
-           artist_longitude
-    FROM staging_songs
-    WHERE artist_id IS NOT NULL;
+def unmatched_plays_report(cur, top=10):
+    """Reports how many song plays could not be matched to a song
+
+    Args:
+        cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
+        top (int): Number of most played unmatched (song, artist) pairs to return
+
+    Returns:
+        dictionary: Number of plays, unmatched plays, match rate and most played unmatched songs
+    """
+    cur.execute(unmatched_plays_summary)
+    plays, unmatched = cur.fetchone()
+    plays, unmatched = plays or 0, unmatched or 0
+    cur.execute(unmatched_plays_top.format(int(top)))
+    return {
+        'plays': plays,
+        'unmatched': unmatched,
+        'match_rate': round(1 - unmatched / plays, 4) if plays else None,
+        'top_unmatched': [{'song': song, 'artist': artist, 'plays': count} for song, artist, count in cur.fetchall()]
+    }
+
+# FINAL TABLES
+
+songplay_table_insert = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT TIMESTAMP 'epoch' + (p.ts / 1000) * INTERVAL '1 Second ',
+           p.user_id,
+           p.level,
+           k.song_id,
+           k.artist_id,
+           p.session_id,
+           p.location,
+           p.user_agent
+    FROM staging_plays p
+    Inner Join staging_song_keys k ON p.play_key = k.song_key
 """)
 
+# Dimensions are upserted: the latest staging row of each key is kept, keys whose row changed are deleted
+# and keys missing from the table are inserted, all within one transaction. Redshift does not enforce
+# primary keys, so this is what keeps a single row per key across loads.
+
+def build_upsert(table, key, columns, source, latest, where):
+    """Builds the statements upserting the latest staging row of each key into a dimension table
+
+    Args:
+        table (string): Dimension table name
+        key (string): Key column of the dimension table
+        columns (list): Dimension column and source expression pairs (the key first)
+        source (string): Staging table the rows are read from
+        latest (string): ORDER BY clause ranking the rows of a key, the first one being kept
+        where (string): Filter on the staging rows
+
+    Returns:
+        list: SQL statements, run as a single transaction
+    """
+    upsert_table = '{}_upsert'.format(table)
+    names = ', '.join(column for column, _ in columns)
+    expressions = [expression if expression == column else '{} AS {}'.format(expression, column)
+                   for column, expression in columns]
+    changed = '\n           OR '.join('({0}.{1} <> u.{1} OR ({0}.{1} IS NULL) <> (u.{1} IS NULL))'.format(table, column)
+                                     for column, _ in columns if column != key)
+    return [
+        'CREATE TEMP TABLE {} (LIKE {});'.format(upsert_table, table),
+        """
+    INSERT INTO {upsert_table} ({names})
+    SELECT {names}
+    FROM (SELECT {expressions},
+                 ROW_NUMBER() OVER (PARTITION BY {key_expression} ORDER BY {latest}) AS latest_rank
+          FROM {source}
+          WHERE {where}) latest
+    WHERE latest_rank = 1;
+""".format(upsert_table=upsert_table, names=names, source=source, latest=latest, where=where,
+           expressions=',\n                 '.join(expressions),
+           key_expression=dict(columns)[key]),
+        """
+    DELETE FROM {table}
+    USING {upsert_table} u
+    WHERE {table}.{key} = u.{key}
+      AND ({changed});
+""".format(table=table, upsert_table=upsert_table, key=key, changed=changed),
+        """
+    INSERT INTO {table} ({names})
+    SELECT {names}
+    FROM {upsert_table} u
+    WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = u.{key});
+""".format(table=table, upsert_table=upsert_table, names=names, key=key),
+        'DROP TABLE {};'.format(upsert_table)
+    ]
+
+# Users keep their latest event (e.g. their current level)
+user_table_insert = build_upsert(
+    'users', 'user_id',
+    [('user_id', 'CAST(user_id AS VARCHAR)'), ('first_name', 'first_name'), ('last_name', 'last_name'),
+     ('gender', 'gender'), ('level', 'level')],
+    'staging_events', 'ts DESC', 'user_id IS NOT NULL')
+
+song_table_insert = build_upsert(
+    'songs', 'song_id',
+    [('song_id', 'song_id'), ('title', 'title'), ('artist_id', 'artist_id'), ('year', 'year'), ('duration', 'duration')],
+    'staging_songs', 'year DESC, duration DESC', 'song_id IS NOT NULL')
+
+# Artists keep a row with a known location when their songs disagree
+artist_table_insert = build_upsert(
+    'artists', 'artist_id',
+    [('artist_id', 'artist_id'), ('name', 'artist_name'), ('location', 'artist_location'),
+     ('latitude', 'artist_latitude'), ('longitude', 'artist_longitude')],
+    'staging_songs', "CASE WHEN artist_location IS NULL OR artist_location = '' THEN 1 ELSE 0 END, artist_name",
+    'artist_id IS NOT NULL')
+
 time_table_insert = ("""
     INSERT INTO time (start_time, hour, day, week, month, year, weekday)
     SELECT DISTINCT (TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 Second ') as ts_timestamp,
@@ -303,11 +1171,111 @@ time_table_insert = ("""
     FROM staging_events;
 """)
 
+# INCREMENTAL LOAD
+# Incremental runs stage only new S3 files, so songplays is matched against the song & artist dimensions
+# (which hold every song loaded so far) instead of staging_songs (which only holds the new song files).
+
+etl_loaded_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_loaded_files (
+        s3_key VARCHAR(1024) NOT NULL,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    );
+""")
+
+# Incremental tables commit on their own connections while the loaded files are only recorded once every table
+# succeeded, so a failed run stages its files again. Rows already loaded are skipped instead of being filtered by
+# event time, so the events of a log file arriving late (or backfilled) are still appended
+
+# staging_song_keys is kept across incremental runs, so new plays are matched on the same key as on a full load
+staging_song_keys_incremental_insert = ("""
+    INSERT INTO staging_song_keys (song_key, song_id, artist_id)
+    SELECT DISTINCT n.song_key, n.song_id, n.artist_id
+    FROM (SELECT {} AS song_key,
+                 song_id,
+                 artist_id
+          FROM staging_songs
+          WHERE title IS NOT NULL
+            AND artist_name IS NOT NULL
+            AND duration IS NOT NULL) n
+    WHERE NOT EXISTS (SELECT 1 FROM staging_song_keys k WHERE k.song_key = n.song_key AND k.song_id = n.song_id);
+""").format(match_key('title', 'artist_name', 'duration'))
+
+songplay_incremental_insert = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT TIMESTAMP 'epoch' + (p.ts / 1000) * INTERVAL '1 Second ',
+           p.user_id,
+           p.level,
+           k.song_id,
+           k.artist_id,
+           p.session_id,
+           p.location,
+           p.user_agent
+    FROM staging_plays p
+    Inner Join staging_song_keys k ON p.play_key = k.song_key
+    WHERE NOT EXISTS (SELECT 1 FROM songplays sp
+                      WHERE sp.start_time = TIMESTAMP 'epoch' + (p.ts / 1000) * INTERVAL '1 Second '
+                        AND sp.user_id = p.user_id
+                        AND sp.session_id = p.session_id
+                        AND sp.song_id = k.song_id);
+""")
+
+time_incremental_insert = ("""
+    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT DISTINCT (TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 Second ') as ts_timestamp,
+           EXTRACT(HOUR FROM ts_timestamp),
+           EXTRACT(DAY FROM ts_timestamp),
+           EXTRACT(WEEK FROM ts_timestamp),
+           EXTRACT(MONTH FROM ts_timestamp),
+           EXTRACT(YEAR FROM ts_timestamp),
+           EXTRACT(DOW FROM ts_timestamp)
+    FROM staging_events e
+    WHERE NOT EXISTS (SELECT 1 FROM time t WHERE t.start_time = TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 Second ');
+""")
+
+# Dimensions are upserted the same way as on a full load
+incremental_sql_tasks = {
+    'staging_plays': {'load': staging_plays_insert, 'upstream': ['staging_events']},
+    'staging_song_keys': {'load': staging_song_keys_incremental_insert, 'upstream': ['staging_songs']},
+    'users': {'load': user_table_insert, 'upstream': ['staging_events']},
+    'songs': {'load': song_table_insert, 'upstream': ['staging_songs']},
+    'artists': {'load': artist_table_insert, 'upstream': ['staging_songs']},
+    'time': {'load': time_incremental_insert, 'upstream': ['staging_events']},
+    'songplays': {'load': songplay_incremental_insert, 'upstream': ['staging_plays', 'staging_song_keys']}
+}
+
+state_table_queries = [etl_loaded_files_table_create]
+
+# TASK GRAPH
+# Every table declares the tables its load statement reads from, so independent tables can be loaded at the same time.
+
+sql_tasks = {
+    'staging_events': {'drop': staging_events_table_drop, 'create': staging_events_table_create,
+                       'load': staging_events_copy, 'upstream': []},
+    'staging_songs': {'drop': staging_songs_table_drop, 'create': staging_songs_table_create,
+                      'load': staging_songs_copy, 'upstream': []},
+    'staging_plays': {'drop': staging_plays_table_drop, 'create': staging_plays_table_create,
+                      'load': staging_plays_insert, 'upstream': ['staging_events'], 'transform': True},
+    'staging_song_keys': {'drop': staging_song_keys_table_drop, 'create': staging_song_keys_table_create,
+                          'load': staging_song_keys_insert, 'upstream': ['staging_songs'], 'transform': True},
+    'songplays': {'drop': songplay_table_drop, 'create': songplay_table_create,
+                  'load': songplay_table_insert, 'upstream': ['staging_plays', 'staging_song_keys']},
+    'users': {'drop': user_table_drop, 'create': user_table_create,
+              'load': user_table_insert, 'upstream': ['staging_events']},
+    'songs': {'drop': song_table_drop, 'create': song_table_create,
+              'load': song_table_insert, 'upstream': ['staging_songs']},
+    'artists': {'drop': artist_table_drop, 'create': artist_table_create,
+                'load': artist_table_insert, 'upstream': ['staging_songs']},
+    'time': {'drop': time_table_drop, 'create': time_table_create,
+             'load': time_table_insert, 'upstream': ['staging_events']}
+}
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create,
-                        user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop,
-                      song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
\ No newline at end of file
+table_order = topological_order(sql_tasks)
+staging_tables = [table for table in table_order if not sql_tasks[table]['upstream']]
+transform_tables = [table for table in table_order if sql_tasks[table].get('transform')]
+final_tables = [table for table in table_order if sql_tasks[table]['upstream'] and not sql_tasks[table].get('transform')]
+
+create_table_queries = [sql_tasks[table]['create'] for table in table_order]
+drop_table_queries = [sql_tasks[table]['drop'] for table in reversed(table_order)]
+insert_table_queries = [sql_tasks[table]['load'] for table in transform_tables + final_tables]
@@ -1,9 +1,14 @@
-import configparser
-import psycopg2
 from sql_objects import *
-from create_resources import config_file
-from delete_resources import delete_resources
+from query_guard import guard_query
+from settings import get_config
+from scheduler import run_task_graph
+from delete_resources import shutdown_resources, get_exit_prompt
+from datetime import datetime
+import argparse
+import json
+import os
 import sys
+import time
 
 # Creates Dictionary with all available questions
 questions = {
@@ -26,11 +31,11 @@ def validation_queries():
     Script entry point, following these steps:
         1. Requests user to input a value according to the question number
         2. Valids user input
-        3. Creates connection to Redshift Cluster
+        3. Checks out a connection from the shared Redshift connection pool
         4. Executes SQL Query according to input by user
         5. Prints the results
     The script will run until the user requests to exit, by pressing 0.
-    All resources will be deleted once the user exits the program.
+    All resources will be paused or deleted (EXIT_ACTION on the cfg file) once the user exits the program.
     Args:
         None
     Returns:
@@ -58,12 +63,12 @@ def validation_queries():
             try:
                 question_number = int(input("Please enter the QUESTION NUMBER you want to answer or [0] to exit: "))
                 if question_number == 0:
-                    answer = str(input("This will delete all AWS Resources. Do you want to proceed? Please enter [y] or [n]: ")).upper()
+                    answer = str(input(get_exit_prompt())).upper()
                     if answer == 'Y':
 
-                        # Delete Resources before exit program.
-                        print('Deleting Resources...')
-                        delete_resources()
+                        # Close pooled connections and pause or delete Resources before exit program.
+                        close_pool()
+                        shutdown_resources()
 
                         # Exit Program
                         print('Exiting Script... Goodbye! \n')
@@ -75,22 +80,168 @@ def validation_queries():
                     print("Error! This is not a valid question number. These are valids QUESTION NUMBER {} ".format(question_list))
                 else:
 
-                    # Connecting to Redshift Cluster
-                    cur, conn = create_connection()
-
                     #Get Query By Question Number
                     query = get_query(question_number)
 
                     #Print Question
                     get_question(question_number)
 
-                    #Execute Query
-                    execute_query(cur, conn, query)
+                    #Inspect the plan of custom queries before running them
+                    statement_timeout = None
+                    if question_number == 4:
+                        # Guard errors (e.g. an unknown POLICY) are reported here, not by the input loop below
+                        try:
+                            guarded = guard_query(query)
+                        except ValueError as e:
+                            print(f'ERROR: {e}')
+                            continue
+                        if guarded['query'] is None:
+                            continue
+                        query, statement_timeout = guarded['query'], guarded['statement_timeout']
+
+                    #Execute Query (canned questions are answered from the result cache when possible)
+                    use_cache = question_number != 4 or get_config().getboolean('CACHE', 'CACHE_CUSTOM_QUERIES', fallback=False)
+                    execute_cached_query(query, use_cache, statement_timeout)
 
             # This is the exception called the attempt to convert the input to integer
             except ValueError:
                 # The cycle will go on until validation
                 print("Error! This is not a number. Try again.")
 
+def load_batch_items(items):
+    """Turns the question numbers and SQL files of a batch into named queries
+
+    Args:
+        items (list): Question numbers (1 to 3) and/or paths to files holding one SQL query each
+
+    Returns:
+        list: (name, query, custom) tuples, custom queries being inspected by the plan guard
+    """
+    batch = []
+    for item in items:
+        if str(item).isdigit():
+            question_number = int(item)
+            if question_number not in questions or question_number == 4:
+                raise ValueError(f'Invalid question number {item}, custom queries are passed as SQL files')
+            batch.append(('question_{}'.format(question_number), get_query(question_number), False))
+        else:
+            with open(item) as f:
+                query = f.read().strip()
+            if not query:
+                raise ValueError(f'{item} holds no query')
+            batch.append((os.path.basename(item), query, True))
+    return batch
+
+def run_batch_query(name, query, custom=False, max_rows=None):
+    """Runs one query of a batch over its own pooled connection
+
+    Args:
+        name (string): Query name on the results
+        query (string): SQL Query
+        custom (boolean): Whether the query goes through the plan guard (canned questions may be answered from the cache)
+        max_rows (int): Stop fetching after this many rows (defaults to MAX_ROWS on the cfg file, 0 means no limit)
+
+    Returns:
+        dictionary: Status, duration, columns, rows and error of the query
+    """
+    config = get_config()
+    max_rows = config.getint('QUERY', 'MAX_ROWS', fallback=0) if max_rows is None else max_rows
+    result = {'name': name, 'query': query, 'status': 'success', 'duration': None, 'cached': False, 'flags': [],
+              'columns': [], 'rows': [], 'row_count': None, 'truncated': False, 'error': None}
+    start = time.time()
+
+    cache = get_result_cache() if not custom or config.getboolean('CACHE', 'CACHE_CUSTOM_QUERIES', fallback=False) else None
+    generation = get_load_generation()
+    statement_timeout, rows = None, None
+    try:
+        cached = cache.get(query, generation) if cache is not None else None
+        if cached is not None:
+            result['cached'] = True
+            result['rows'] = [list(row) for row in cached]
+        else:
+            if custom:
+                guarded = guard_query(query)
+                result['flags'] = guarded['flags']
+                if guarded['query'] is None:
+                    raise RuntimeError('Query refused by the plan guard')
+                query, statement_timeout = guarded['query'], guarded['statement_timeout']
+
+            with get_pool().connection(get_query_group('interactive'), statement_timeout) as (cur, conn):
+                cur.execute(query)
+                if cur.description is not None:
+                    result['columns'] = [column[0] for column in cur.description]
+                    rows = cur.fetchmany(max_rows + 1) if max_rows else cur.fetchall()
+                    result['truncated'] = bool(max_rows) and len(rows) > max_rows
+                    rows = rows[:max_rows] if max_rows else rows
+                    result['rows'] = [list(row) for row in rows]
+                else:
+                    result['row_count'] = cur.rowcount
+                conn.commit()
+            if cache is not None and rows is not None and not result['truncated']:
+                cache.put(query, generation, rows)
+        if result['row_count'] is None:
+            result['row_count'] = len(result['rows'])
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e).strip()
+    result['duration'] = round(time.time() - start, 3)
+    return result
+
+def run_batch(items, max_workers=None, output=None):
+    """Runs question numbers and SQL files at the same time, each over its own pooled connection, and writes the results as JSON
+
+    Args:
+        items (list): Question numbers (1 to 3) and/or paths to files holding one SQL query each
+        max_workers (int): Maximum number of queries running at the same time (defaults to MAX_WORKERS on the cfg file)
+        output (string): JSON results file (defaults to OUTPUT on the cfg file)
+
+    Returns:
+        dictionary: Batch results, with the status, duration & rows of each query
+    """
+    config = get_config()
+    if max_workers is None:
+        max_workers = config.getint('BATCH', 'MAX_WORKERS', fallback=config.getint('POOL', 'MAX_SIZE', fallback=5))
+    output = output or config.get('BATCH', 'OUTPUT', fallback='batch_results.json')
+
+    batch = load_batch_items(items)
+    tasks = {name: {'query': query, 'custom': custom, 'upstream': []} for name, query, custom in batch}
+    if len(tasks) != len(batch):
+        raise ValueError('Every query of a batch needs a distinct name')
+
+    results = {'mode': 'batch', 'started_at': datetime.utcnow().isoformat(), 'load_generation': get_load_generation()}
+    start = time.time()
+    completed = run_task_graph(tasks, lambda name: run_batch_query(name, tasks[name]['query'], tasks[name]['custom']),
+                               max_workers)
+    results['duration'] = round(time.time() - start, 3)
+    results['queries'] = [dict(completed[name], name=name) for name, _, _ in batch]
+    results['success'] = all(query['status'] == 'success' for query in results['queries'])
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+
+    for query in results['queries']:
+        print('{:<30} {:<8} {:>10} {:>10}'.format(query['name'], query['status'], str(query['duration']),
+                                                   str(query.get('row_count'))))
+        if query.get('error'):
+            print(f"  {query['error']}")
+    print(f"Batch ran in {results['duration']}s, results written to {output}")
+    return results
+
 if __name__ == '__main__':
-    validation_queries()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Answers the validation questions, interactively or as a batch')
+    parser.add_argument('--batch', nargs='+', metavar='ITEM', help='Question numbers (1 to 3) and/or SQL files to run at the same time')
+    parser.add_argument('--workers', type=int, help='Maximum number of queries running at the same time (defaults to MAX_WORKERS on the cfg file)')
+    parser.add_argument('--output', help='JSON results file (defaults to OUTPUT on the cfg file)')
+    args = parser.parse_args()
+
+    if not args.batch:
+        validation_queries()
+    else:
+        try:
+            results = run_batch(args.batch, args.workers, args.output)
+        except (OSError, ValueError) as e:
+            print(f'ERROR: {e}')
+            sys.exit(2)
+        finally:
+            close_pool()
+        sys.exit(0 if results['success'] else 1)
\ No newline at end of file